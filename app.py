@@ -1,13 +1,25 @@
+import startup  # must stay first to time the imports below when STARTUP_PROFILE=1
 import os
 import datetime
+import math
+import secrets
+import sqlite3
 import uuid
-from flask import Flask, flash, redirect, render_template, request, session, g, jsonify
-from flask_session import Session
+from importlib import metadata
+from importlib.util import find_spec
+from flask import Flask, flash, redirect, render_template, stream_template, request, session, g, jsonify, url_for, send_from_directory
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-from werkzeug.security import check_password_hash, generate_password_hash
-from helpers import apology, login_required, lookup, usd, get_stock_chart
-from database import close_db, initialize_database, execute_query, execute_multiple_queries
+from helpers import apology, login_required, lookup, lookup_many, quotes_updated_at, usd, get_stock_chart, PRICE_REFRESHER, QUOTE_CACHE_TTL
+from stream import PriceFeed, PRICE_STREAMING, STREAM_INTERVAL, STREAM_MAX_SYMBOLS
+from sessions import SQLiteSessionInterface, start_session_purger
+import limiter_storage  # registers the sqlite:/// rate limit storage
+from passwords import hasher, PasswordPoolBusy
+import matching
+import metrics
+import repository
+from dataclasses import replace
+from database import close_db, initialize_database, execute_transaction, try_transaction, TransactionError
 from datetime import timedelta
 
 # Configure application
@@ -15,20 +27,65 @@ app = Flask(__name__)
 
 # Custom filter
 app.jinja_env.filters["usd"] = usd
+# Whether pages stream live prices or poll for them
+app.jinja_env.globals["price_streaming"] = PRICE_STREAMING
+app.jinja_env.globals["stream_interval"] = STREAM_INTERVAL
+
+# Count template rendering towards the render phase of the Server-Timing header and /metrics
+render_template = metrics.timed("render")(render_template)
 
 # Session timout configuration
 app.config["SESSION_PERMANENT"] = True
 app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(minutes=15)
-# Configure session to use filesystem (instead of signed cookies)
-app.config["SESSION_TYPE"] = "filesystem"
+# Store sessions in the database (instead of signed cookies)
+app.session_interface = SQLiteSessionInterface()
 # Prevent JavaScript from accessing the session cookie
 app.config["SESSION_COOKIE_HTTPONLY"] = True
 # Prevent cookies from being sent with cross-site requests
 app.config["SESSION_COOKIE_SAMESITE"] = "Lax"
-Session(app)
+# Let browsers cache static files for an hour
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = timedelta(hours=1)
+
+# How often the portfolio page stores a fresh valuation in the portfolio summary
+PORTFOLIO_VALUATION_INTERVAL = timedelta(minutes=1)
+# Number of transactions per history page
+HISTORY_PAGE_SIZE = 100
+# Number of proposals per P2P board page
+P2P_PAGE_SIZE = 50
+# Maximum number of orders in one /orders request
+MAX_BULK_ORDERS = 50
+# Maximum number of symbols in one /quote_json request
+MAX_QUOTE_SYMBOLS = 50
+# Chart periods available through /chart_json
+CHART_PERIODS = ("1mo", "3mo", "6mo", "1y")
+# plotly.js ships with the plotly package, so it is served from there instead of inlined into every chart
+# (located without importing plotly, which is only loaded once a chart is built)
+PLOTLY_VERSION = metadata.version("plotly")
+PLOTLY_JS_DIR = os.path.join(os.path.dirname(find_spec("plotly").origin), "package_data")
 
 # Initialize database
-initialize_database()
+with startup.step("initialize_database"):
+    initialize_database()
+
+# Remove expired sessions in the background
+start_session_purger()
+
+# Shared price feed for streaming clients
+price_feed = PriceFeed(app)
+
+# Keep local stock prices fresh in the background if enabled, with several server workers only one of them refreshes
+if PRICE_REFRESHER:
+    from refresher import start_price_refresher
+    start_price_refresher()
+
+# Time every request, registered first so the timing starts before and ends after the other request hooks
+@app.before_request
+def start_timing():
+    metrics.start_request()
+
+@app.after_request
+def finish_timing(response):
+    return metrics.finish_request(response, request.endpoint)
 
 # Ensure database connections close properly
 @app.teardown_appcontext
@@ -37,35 +94,48 @@ def teardown_db(exception):
 
 # Rate-limiting key function
 def rate_limit_key():
-    return session.get("user_id") or session.get("device_id") or get_remote_address()
+    if session.get("user_id"):
+        return str(session["user_id"])
+    # Before login clients are limited by address, a device ID is handed out by the server and could simply be dropped
+    return get_remote_address()
+
+# Rate limit counters are kept in memory by default, use e.g. sqlite:///mockstocks.db or redis://localhost:6379 to share them between processes
+app.config["RATELIMIT_STORAGE_URI"] = os.environ.get("RATELIMIT_STORAGE_URI", "memory://")
 
 # Initialize Flask-Limiter with key function
 limiter = Limiter(
-    get_remote_address,
+    rate_limit_key,
     app=app,
     default_limits=["100 per hour"]
 )
 
 @app.before_request
 def manage_session():
-    # Ensure session follows configured lifetime
-    session.permanent = True  
+    # Metrics scrapers don't need a session
+    if request.endpoint == "prometheus_metrics":
+        return
+
+    # Ensure session follows configured lifetime, setting it again would mark session as modified
+    if not session.permanent:
+        session.permanent = True
 
     # Assign device ID if not present
     if "device_id" not in session:
         session["device_id"] = request.cookies.get("device_id", str(uuid.uuid4()))
 
-    if "user_id" in session:
-        # Reset timeout on user activity
-        session.modified = True  
-    elif request.endpoint not in ["login", "register", "static"]:
+    # Timeout is reset on user activity by the session interface, which stores the new expiry every SESSION_WRITE_INTERVAL
+    if "user_id" not in session and request.endpoint not in ["login", "register", "static"]:
         # Redirect if session expired
         return redirect("/login")
 
-# Prevent browsers from caching responses
+# Prevent browsers from caching authenticated pages
 @app.after_request
 def after_request(response):
-    """Ensure responses aren't cached"""
+    """Ensure authenticated HTML pages aren't cached"""
+    # Static files and price JSON set their own caching headers
+    if "user_id" not in session or response.mimetype != "text/html":
+        return response
+
     response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     response.headers["Expires"] = 0
     response.headers["Pragma"] = "no-cache"
@@ -75,6 +145,15 @@ def after_request(response):
 def ratelimit_exceeded(e):
     return apology("Too many attempts, come back later", 429)
 
+@app.errorhandler(PasswordPoolBusy)
+def password_pool_busy(e):
+    return apology(str(e), 503)
+
+@app.errorhandler(sqlite3.Error)
+def database_error(e):
+    print(f"Database error: {e}")
+    return apology("Something went wrong, please try again", 500)
+
 
 @app.route("/")
 @login_required
@@ -84,32 +163,34 @@ def index():
     # user_id variable for later use
     user_id = session["user_id"]
 
-    # Get stock tickers, average price and the amount of stocks owned by this user
-    stocks = execute_query(
-        """SELECT frozen_amount, avg_price, stock_ticker AS stock_owned, amount AS amount_owned
-        FROM stock_ownership
-        WHERE user_id = ? AND amount > 0""",
-        (user_id,)
-    )
+    # Get stock tickers, average price and the amount of stocks owned by this user, including stocks entirely
+    # frozen in P2P proposals, so they are valued against the same holdings the cost basis adds up
+    stocks = repository.list_holdings(user_id, include_frozen=True)
 
-    # Populate current prices dictionary with up-to-date stock prices
-    current_prices = {}
-    for stock in range(len(stocks)):
-        quote = lookup(stocks[stock]["stock_owned"])
-        current_prices[stocks[stock]["stock_owned"]] = quote["price"]
+    # Populate current prices dictionary with up-to-date stock prices in one batch
+    current_prices, stale_prices = lookup_many([stock.stock_ticker for stock in stocks])
 
-    # Find out how much cash user has
-    cash = execute_query("SELECT cash, frozen_cash FROM users WHERE id = ?", (user_id,))
+    # Stocks that could not be priced at all are valued at their average purchase price
+    for stock in stocks:
+        if stock.stock_ticker not in current_prices:
+            current_prices[stock.stock_ticker] = stock.avg_price
+            stale_prices.add(stock.stock_ticker)
+
+    # Find out how much cash user has and the precomputed summary of their holdings
+    portfolio = repository.get_portfolio(user_id)
 
     # Calculate how much currently owned stocks by user are worth in current prices
-    sum_total = sum((stock["amount_owned"] + stock["frozen_amount"]) * current_prices[stock["stock_owned"]] for stock in stocks)
+    total_current_value = sum(current_prices[stock.stock_ticker] * (stock.amount + stock.frozen_amount) for stock in stocks)
 
-    # Calculate total purchase value, current value and profit/loss
-    total_purchase_value = sum(stock["avg_price"] * (stock["amount_owned"] + stock["frozen_amount"]) for stock in stocks)
-    total_current_value = sum(current_prices[stock["stock_owned"]] * (stock["amount_owned"] + stock["frozen_amount"]) for stock in stocks)
+    # Total purchase value is maintained with every trade, so only profit/loss is left to calculate
+    total_purchase_value = portfolio.cost_basis
     total_profit_loss = total_current_value - total_purchase_value
+
+    # Remember the valuation for anything that reads portfolio values without live prices, skipped while trades hold the database
+    if not stale_prices and (portfolio.valued_at is None or datetime.datetime.now() - portfolio.valued_at > PORTFOLIO_VALUATION_INTERVAL):
+        try_transaction([repository.record_valuation(user_id, total_current_value)])
   
-    return render_template("index.html", stocks=stocks, current_prices=current_prices, cash=cash, sum_total=sum_total, 
+    return render_template("index.html", stocks=stocks, current_prices=current_prices, stale_prices=stale_prices, portfolio=portfolio, sum_total=total_current_value, 
                            total_profit_loss=total_profit_loss, total_current_value=total_current_value, total_purchase_value=total_purchase_value)
 
 
@@ -144,16 +225,16 @@ def login():
             return apology("password too long", 400)
 
         # Query database for username
-        rows = execute_query("SELECT * FROM users WHERE username = ?", (username,))
+        user = repository.get_user_by_username(username)
 
         # Ensure username exists and password is correct
-        if len(rows) != 1 or not check_password_hash(
-            rows[0]["hash"], password
+        if user is None or not hasher.verify(
+            user.hash, password
         ):
             return apology("invalid username and/or password", 400)
 
         # Remember which user has logged in
-        session["user_id"] = rows[0]["id"]
+        session["user_id"] = user.id
 
         # Redirect user to home page
         return redirect("/")
@@ -188,11 +269,8 @@ def register():
         if not username:
             return apology("must provide username", 400)        
 
-        # Look for username in database
-        rows = execute_query("SELECT * FROM users WHERE username = ?", (username,))
-
         # Check whether username already exists in database
-        if len(rows) != 0:
+        if repository.get_user_by_username(username) is not None:
             return apology("username already exists", 400)
         # Check whether username is too long
         elif len(username) > 25:
@@ -214,14 +292,16 @@ def register():
             return apology("passwords do not match", 400)
 
         # Generate hash of the password
-        passhash = generate_password_hash(password)
+        passhash = hasher.hash(password)
 
         # Store user in database
-        execute_query("INSERT INTO users (username, hash) VALUES (?, ?)", (username, passhash))
+        try:
+            execute_transaction([repository.insert_user(username, passhash)])
+        except TransactionError as e:
+            return apology(str(e), e.code)
 
         # Store id in session now that user is registered
-        id = execute_query("SELECT id FROM users WHERE username=?", (username,))        
-        session["user_id"] = id[0]["id"]
+        session["user_id"] = repository.get_user_by_username(username).id
 
         flash("Thanks for registering! Now you are logged in.")
         return redirect("/")
@@ -256,11 +336,8 @@ def quote():
         price = stock["price"]
         symbol = stock["symbol"]
 
-        # Generate stock chart from yfinance using plotly
-        chart = get_stock_chart(symbol)
-
-        # If quote is available we render info
-        return render_template("quoted.html", name=name, price=price, symbol=symbol, chart=chart)
+        # If quote is available we render info, the chart is loaded by the page from /chart_json
+        return render_template("quoted.html", name=name, price=price, symbol=symbol, plotly_version=PLOTLY_VERSION)
 
     return render_template("quote.html")
 
@@ -297,41 +374,25 @@ def buy():
         if float(shares) < 0:
             return apology("the number of shares must be positive", 400)
 
-        # Get how much cash user has
-        usercash = execute_query("SELECT cash FROM users WHERE id=?", (user_id,))
+        # Execute multiple queries to buy stock
+        try:
+            execute_transaction([
+
+                # Update user cash, only if user has enough cash to complete purchase
+                repository.debit_cash(user_id, shares * quote["price"], "There is not enough cash to complete this purchase"),
 
-        # Check whether user has enough cash to complete purchase
-        if float(shares * quote["price"]) > float(usercash[0]["cash"]):
-            return apology("There is not enough cash to complete this purchase", 400)
+                # Add stock buy into database
+                repository.insert_market_transaction(user_id, symbol, shares, quote["price"], "BUY"),
 
-        # Execute multiple queries to buy stock
-        execute_multiple_queries([
+                # Add stock into user's portfolio
+                repository.add_shares(user_id, symbol, shares, quote["price"]),
 
-            # Add stock buy into database
-            (
-            "INSERT INTO market_transactions (time_transacted, stock_ticker, price_per_share, shares, type, user_id) VALUES (?, ?, ?, ?, ?, ?)",
-                (datetime.datetime.now(), symbol, quote["price"], shares, "BUY", user_id)
-            ),
-            
-            # Add stock into user's portfolio
-            (
-            """INSERT INTO stock_ownership (stock_ticker, amount, avg_price, user_id) 
-                VALUES (?, ?, ?, ?)
-                ON CONFLICT(user_id, stock_ticker)        
-                DO UPDATE SET 
-                    amount = stock_ownership.amount + ?,  
-                    avg_price = ((stock_ownership.avg_price * stock_ownership.amount) + (? * ?)) / (stock_ownership.amount + ?);
-                """, 
-                (symbol, shares, quote["price"], user_id, shares, quote["price"], shares, shares)
-            ),
-
-            # Update user cash after completing purchase
-            (
-                "UPDATE users SET cash = cash - ? WHERE id = ?", 
-                (shares * quote["price"], user_id)
-            ),
-
-        ])
+                # Update user's portfolio summary
+                repository.refresh_portfolio_summary(user_id)
+
+            ])
+        except TransactionError as e:
+            return apology(str(e), e.code)
 
         # When transaction is successful redirect to index and flash message
         flash("Bought!")
@@ -350,12 +411,7 @@ def sell():
     user_id = session["user_id"]
 
     # Get stock tickers and the amount of stocks owned by this user
-    stocks_owned = execute_query(
-        """SELECT stock_ticker AS stock_owned, amount AS amount_owned
-        FROM stock_ownership
-        WHERE user_id = ? AND amount > 0""",
-        (user_id,)
-    )
+    stocks_owned = repository.list_holdings(user_id)
 
     # Do this if user accesses page with POST method
     if request.method == "POST":
@@ -371,9 +427,9 @@ def sell():
         stock_exists = False
         amount_owned = 0
         for stock in stocks_owned:
-            if stock["stock_owned"] == user_stock:
+            if stock.stock_ticker == user_stock:
                 stock_exists = True
-                amount_owned = stock["amount_owned"]
+                amount_owned = stock.amount
                 break
         if stock_exists == False:
             return apology("User doesn't own this stock", 400)
@@ -397,33 +453,27 @@ def sell():
             return apology("Stock quote not found", 400)
 
         # Execute multiple queries to sell stock
-        execute_multiple_queries([
+        try:
+            execute_transaction([
 
-            # Insert stock sell into database
-            (
-                "INSERT INTO market_transactions (time_transacted, stock_ticker, price_per_share, shares, type, user_id) VALUES (?, ?, ?, ?, ?, ?)",
-                (datetime.datetime.now(), user_stock, quote["price"], stock_amount, "SELL", user_id)
-            ),
-            
-            # Reduce stock amount owned by user
-            (
-                "UPDATE stock_ownership SET amount = amount - ? WHERE user_id = ? AND stock_ticker = ?",
-                (stock_amount, user_id, user_stock)
-            ),
-
-            # Remove stock entry if amount becomes zero
-            (
-                "DELETE FROM stock_ownership WHERE user_id = ? AND stock_ticker = ? AND amount = 0",
-                (user_id, user_stock)
-            ),
-
-            # Update cash for user
-            (
-                "UPDATE users SET cash = cash + ? WHERE id = ?",
-                (float(quote["price"]) * float(stock_amount), user_id)
-            )
-
-        ])
+                # Reduce stock amount owned by user, only if user still owns this many stocks
+                repository.remove_shares(user_id, user_stock, float(stock_amount), "You don't have enough stocks to sell"),
+
+                # Insert stock sell into database
+                repository.insert_market_transaction(user_id, user_stock, float(stock_amount), quote["price"], "SELL"),
+
+                # Remove stock entry if amount becomes zero
+                repository.delete_empty_holding(user_id, user_stock),
+
+                # Update cash for user
+                repository.credit_cash(user_id, float(quote["price"]) * float(stock_amount)),
+
+                # Update user's portfolio summary
+                repository.refresh_portfolio_summary(user_id)
+
+            ])
+        except TransactionError as e:
+            return apology(str(e), e.code)
 
         flash("Sold!")
         return redirect("/")
@@ -431,44 +481,123 @@ def sell():
     return render_template("sell.html", stocks_owned=stocks_owned)
 
 
-@app.route("/history")
+@app.route("/orders", methods=["POST"])
+@limiter.limit("60 per minute")
 @login_required
-def history():
-    """Show history of transactions"""
+def orders():
+    """
+    Buy and sell several stocks at once, e.g. to rebalance a portfolio.
+    Takes JSON {"orders": [{"symbol": "AAPL", "side": "buy", "shares": 2}, ...]} and returns a result per order.
+    Orders are checked in the given order against user's cash and holdings, and all valid ones are applied in one transaction.
+    """
 
     # user_id variable for later use
     user_id = session["user_id"]
 
-    # Get combined transactions from buys and sells from database
-    transactions = execute_query("""
-        SELECT time_transacted AS time, stock_ticker AS ticker, price_per_share AS price, 
-            shares AS amount, type, user_id, 'MARKET' AS transaction_source
-        FROM market_transactions
-        WHERE user_id = ?
+    # Get orders from request body
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("orders"), list) or not data["orders"]:
+        return jsonify({"error": "Must provide a list of orders"}), 400
+    if len(data["orders"]) > MAX_BULK_ORDERS:
+        return jsonify({"error": "Too many orders"}), 400
+
+    # Get current prices for all stocks in one batch, stale prices aren't traded on
+    symbols = [str(order.get("symbol", "")).upper().strip() if isinstance(order, dict) else "" for order in data["orders"]]
+    prices, stale = lookup_many([symbol for symbol in symbols if symbol])
+
+    # Get user's cash and owned stocks once, then check every order against what is left after the previous ones
+    cash = repository.get_portfolio(user_id).cash
+    owned = {stock.stock_ticker: stock.amount for stock in repository.list_holdings(user_id)}
+
+    results = []
+    queries = []
+    for order, symbol in zip(data["orders"], symbols):
+        side = str(order.get("side", "")).lower() if isinstance(order, dict) else ""
+        result = {"symbol": symbol, "side": side}
+        results.append(result)
+
+        # Check whether order is valid
+        try:
+            shares = float(order.get("shares"))
+        except (AttributeError, TypeError, ValueError):
+            shares = None
+        if not symbol:
+            result["error"] = "Must provide stock symbol"
+        elif side not in ("buy", "sell"):
+            result["error"] = "Side must be buy or sell"
+        elif shares is None or not 0 < shares < float("inf"):
+            result["error"] = "Number of shares must be a positive number"
+        elif symbol not in prices:
+            result["error"] = "No such stock found"
+        elif symbol in stale:
+            result["error"] = "Stock price is not available right now"
+        elif side == "buy" and shares * prices[symbol] > cash:
+            result["error"] = "There is not enough cash to complete this purchase"
+        elif side == "sell" and shares > owned.get(symbol, 0):
+            result["error"] = "You don't have enough stocks to sell"
+        if "error" in result:
+            result["status"] = "rejected"
+            continue
+
+        price = prices[symbol]
+        result.update(status="filled", shares=shares, price=price)
+        if side == "buy":
+            cash -= shares * price
+            owned[symbol] = owned.get(symbol, 0) + shares
+            queries += [
+                repository.debit_cash(user_id, shares * price, "There is not enough cash to complete these orders"),
+                repository.insert_market_transaction(user_id, symbol, shares, price, "BUY"),
+                repository.add_shares(user_id, symbol, shares, price),
+            ]
+        else:
+            cash += shares * price
+            owned[symbol] -= shares
+            queries += [
+                repository.remove_shares(user_id, symbol, shares, "You don't have enough stocks to complete these orders"),
+                repository.insert_market_transaction(user_id, symbol, shares, price, "SELL"),
+                repository.delete_empty_holding(user_id, symbol),
+                repository.credit_cash(user_id, shares * price),
+            ]
+
+    # Execute all valid orders with one commit, cash and holdings are checked again in case they changed meanwhile
+    if queries:
+        try:
+            execute_transaction(queries + [repository.refresh_portfolio_summary(user_id)])
+        except TransactionError as e:
+            return jsonify({"error": str(e)}), e.code
 
-        UNION ALL
+    return jsonify({"results": results, "cash": cash})
 
-        SELECT time_transacted AS time, stock_ticker AS ticker, price_per_share AS price, 
-            shares AS amount, 'BUY' AS type, buyer_id AS user_id, 'P2P' AS transaction_source
-        FROM p2p_transactions
-        WHERE buyer_id = ?
 
-        UNION ALL
+@app.route("/history")
+@login_required
+def history():
+    """Show history of transactions"""
 
-        SELECT time_transacted AS time, stock_ticker AS ticker, price_per_share AS price, 
-            shares AS amount, 'SELL' AS type, seller_id AS user_id, 'P2P' AS transaction_source
-        FROM p2p_transactions
-        WHERE seller_id = ?
+    # user_id variable for later use
+    user_id = session["user_id"]
 
-        ORDER BY time_transacted
-    """, (user_id, user_id, user_id))
-    
-    # Convert to datetime object
-    transactions = [dict(transaction) for transaction in transactions]
-    for transaction in transactions:
-        transaction["time"] = datetime.datetime.strptime(transaction["time"], "%Y-%m-%d %H:%M:%S.%f")
+    # Full history is streamed to the browser while it is read page by page from database
+    if request.args.get("all"):
+        return stream_template("history.html", transactions=repository.iter_transactions(user_id), show_all=True)
+
+    # Otherwise show one page, starting after the cursor of the last transaction on previous page
+    before = None
+    if request.args.get("before"):
+        try:
+            time, transaction_id, kind = request.args["before"].rsplit(",", 2)
+            before = (datetime.datetime.fromisoformat(time).isoformat(" "), int(transaction_id), int(kind))
+        except ValueError:
+            return apology("invalid page", 400)
+
+    # Get combined transactions from buys and sells from database, one extra to know if there's a next page
+    transactions = repository.list_transactions(user_id, HISTORY_PAGE_SIZE + 1, before)
+    next_cursor = None
+    if len(transactions) > HISTORY_PAGE_SIZE:
+        transactions = transactions[:HISTORY_PAGE_SIZE]
+        next_cursor = ",".join(map(str, transactions[-1].cursor))
 
-    return render_template("history.html", transactions=transactions)
+    return render_template("history.html", transactions=transactions, next_cursor=next_cursor, show_all=False)
 
 
 @app.route("/profile", methods=["GET", "POST"])
@@ -480,7 +609,7 @@ def profile():
     # user_id variable for later use
     user_id = session["user_id"]
 
-    username = execute_query("SELECT username FROM users WHERE id = ?", (user_id,))[0]["username"]
+    user = repository.get_user(user_id)
 
     # Do this if page was accessed through POST method
     if request.method == "POST":
@@ -489,15 +618,12 @@ def profile():
             # Get new username input from user
             new_username = request.form.get("new_username").strip()
 
-            # Look for username in database
-            rows = execute_query("SELECT * FROM users WHERE username = ?", (new_username,))
-
             # Check whether user entered a new username
             if not new_username:
                 return apology("Must provide username", 400)
 
             # Check whether username alrady exists in database
-            elif len(rows) != 0:
+            elif repository.get_user_by_username(new_username) is not None:
                 return apology("Username already exists", 400)
             
             # Check whether username is not too long
@@ -505,7 +631,10 @@ def profile():
                 return apology("Username is too long", 400)
 
             # Change username
-            execute_query("UPDATE users SET username = ? WHERE id = ?", (new_username, user_id))
+            try:
+                execute_transaction([repository.update_username(user_id, new_username)])
+            except TransactionError as e:
+                return apology(str(e), e.code)
 
             flash("Succesfully changed username!")
             return redirect("/profile")
@@ -521,8 +650,7 @@ def profile():
                 return apology("Must enter all password fields", 400)
 
             # Check whether old password is correct
-            database_hash = execute_query("SELECT hash FROM users WHERE id = ?", (user_id,))[0]["hash"]
-            if not check_password_hash(database_hash, old_password):
+            if not hasher.verify(user.hash, old_password):
                 return apology("Old password is incorrect", 400)
 
             # Check whether new password and password confirmation match
@@ -538,13 +666,16 @@ def profile():
                 return apology("New password is too long", 400)
 
             # Change password
-            passhash = generate_password_hash(new_password)
-            execute_query("UPDATE users SET hash = ? WHERE id = ?", (passhash, user_id))
+            passhash = hasher.hash(new_password)
+            try:
+                execute_transaction([repository.update_password_hash(user_id, passhash)])
+            except TransactionError as e:
+                return apology(str(e), e.code)
 
             flash("Succesfully changed password!")
             return redirect("/profile")
 
-    return render_template("profile.html", username=username)
+    return render_template("profile.html", username=user.username)
 
 
 @app.route("/p2p", methods=["GET", "POST"])
@@ -556,14 +687,6 @@ def p2p():
     # user_id variable for later use
     user_id = session["user_id"]
 
-    # Get all p2p trade proposals
-    p2p_trades = execute_query("SELECT p2p_market.*, users.username FROM p2p_market JOIN users ON p2p_market.user_id = users.id")
-
-    # Convert to datetime object
-    p2p_trades = [dict(p2p_trade) for p2p_trade in p2p_trades]
-    for p2p_trade in p2p_trades:
-        p2p_trade["time_posted"] = datetime.datetime.strptime(p2p_trade["time_posted"], "%Y-%m-%d %H:%M:%S.%f")
-
     if request.method == "POST":
         # Get user inputs
         trade_id = request.form.get("trade_id")
@@ -576,150 +699,65 @@ def p2p():
             return apology("Invalid request", 400)
 
         # Get trade details
-        trade = execute_query("SELECT * FROM p2p_market WHERE p2p_id = ?", (trade_id,))
-        trade = trade[0]
-
-        # Do this if we want to sell stocks to someone who is buying
-        if trade["type"] == "BUYING":
-
-            # Get stocks owned by user
-            stocks_owned = execute_query(
-                """SELECT stock_ticker AS stock_owned, amount AS amount_owned
-                FROM stock_ownership
-                WHERE user_id = ? AND amount > 0""",
-                (user_id,)
-            )
-            
-            # Check whether user has enough stocks to sell
-            stock_exists = False
-            amount_owned = 0
-            for stock in stocks_owned:
-                if stock["stock_owned"] == trade["stock_ticker"]:
-                    stock_exists = True
-                    amount_owned = stock["amount_owned"]
-                    break
-            if stock_exists == False:
-                return apology("User doesn't own this stock", 400)
-            if trade["amount"] > amount_owned:
-                return apology("You don't have enough stocks to sell", 400)
+        trade = repository.get_proposal(trade_id)
+        if not trade:
+            return apology("This trade is no longer available", 400)
 
-            # Execute multiple queries to sell user's stock in p2p market
-            execute_multiple_queries([
-
-                # Insert stock sell into database
-                (
-                    "INSERT INTO p2p_transactions (time_transacted, stock_ticker, price_per_share, shares, buyer_id, seller_id) VALUES (?, ?, ?, ?, ?, ?)",
-                    (datetime.datetime.now(), trade["stock_ticker"], trade["price"], trade["amount"], trade["user_id"], user_id)
-                ),
-                
-                # Remove frozen cash from buyer user
-                (
-                    "UPDATE users SET frozen_cash = frozen_cash - ? WHERE id = ?", 
-                    (trade["price"] * trade["amount"], trade["user_id"])
-                ),
-
-                # Add stock into buyer user's portfolio
-                (
-                    """
-                    INSERT INTO stock_ownership (stock_ticker, amount, avg_price, user_id) 
-                    VALUES (?, ?, ?, ?)
-                    ON CONFLICT(user_id, stock_ticker)        
-                    DO UPDATE SET 
-                        amount = stock_ownership.amount + ?,  
-                        avg_price = ((stock_ownership.avg_price * stock_ownership.amount) + (? * ?)) / (stock_ownership.amount + ?);
-                    """, 
-                    (trade["stock_ticker"], trade["amount"], trade["price"], trade["user_id"], trade["amount"], trade["price"], trade["amount"], trade["amount"])
-                ),
-
-                # Update stock ownership after completing sale
-                (
-                    "UPDATE stock_ownership SET amount = amount - ? WHERE user_id = ? AND stock_ticker = ?",
-                    (trade["amount"], user_id, trade["stock_ticker"])
-                ),
-
-                # Remove stock entry if amount becomes zero
-                (
-                    "DELETE FROM stock_ownership WHERE user_id = ? AND stock_ticker = ? AND amount = 0",
-                    (user_id, trade["stock_ticker"])
-                ),
-
-                # Update user cash after completing purchase
-                (
-                    "UPDATE users SET cash = cash + ? WHERE id = ?", 
-                    (trade["price"] * trade["amount"], user_id)
-                ),
-                
-                # Remove trade from p2p_market
-                (
-                    "DELETE FROM p2p_market WHERE p2p_id = ?", 
-                    (trade_id,)
-                )
-            
-            ])
+        # Users can't accept their own trades
+        if trade.user_id == user_id:
+            return apology("You can't accept your own trade", 400)
 
-            flash("Sold!")
-            return redirect("/p2p")
-        
-        # Do this if we want to buy stocks that someone is selling
-        if trade["type"] == "SELLING":
-
-            # Check whether user has enough cash to buy the stocks
-            user_cash = execute_query("SELECT cash FROM users WHERE id = ?", (user_id,))
-            if trade["amount"] * trade["price"] > user_cash[0]["cash"]:
-                return apology("You don't have enough cash to buy these stocks", 400)
-
-            # Execute multiple queries to buy the stock in p2p market
-            execute_multiple_queries([
-
-                # Insert stock buy into database
-                (
-                    "INSERT INTO p2p_transactions (time_transacted, stock_ticker, price_per_share, shares, seller_id, buyer_id) VALUES (?, ?, ?, ?, ?, ?)",
-                    (datetime.datetime.now(), trade["stock_ticker"], trade["price"], trade["amount"], trade["user_id"], user_id)
-                ),
-                
-                # Remove frozen stocks from seller user
-                (
-                    "UPDATE stock_ownership SET frozen_amount = frozen_amount - ? WHERE user_id = ? AND stock_ticker = ?", 
-                    (trade["amount"], trade["user_id"], trade["stock_ticker"])
-                ),
-
-                # add cash to seller user
-                (
-                    "UPDATE users SET cash = cash + ? WHERE id = ?", 
-                    (trade["price"] * trade["amount"], trade["user_id"])
-                ),
+        # Get how many shares user wants to trade, the whole trade unless user asked for fewer
+        shares = request.form.get("shares") or trade.amount
+        try:
+            shares = float(shares)
+        except ValueError:
+            return apology("The number of stocks should be a valid number", 400)
+        if not 0 < shares <= trade.amount:
+            return apology(f"The number of stocks should be between 0 and {trade.amount:g}", 400)
 
-                # Add stock into user's portfolio
-                (
-                    """
-                    INSERT INTO stock_ownership (stock_ticker, amount, avg_price, user_id) 
-                    VALUES (?, ?, ?, ?)
-                    ON CONFLICT(user_id, stock_ticker)        
-                    DO UPDATE SET 
-                        amount = stock_ownership.amount + ?,  
-                        avg_price = ((stock_ownership.avg_price * stock_ownership.amount) + (? * ?)) / (stock_ownership.amount + ?);
-                    """, 
-                    (trade["stock_ticker"], trade["amount"], trade["price"], user_id, trade["amount"], trade["price"], trade["amount"], trade["amount"])
-                ),
-
-                # Update user cash after completing purchase
-                (
-                    "UPDATE users SET cash = cash - ? WHERE id = ?", 
-                    (trade["price"] * trade["amount"], user_id)
-                ),
-                
-                # Remove trade from p2p_market
-                (
-                    "DELETE FROM p2p_market WHERE p2p_id = ?", 
-                    (trade_id,)
-                )
+        # User takes the other side of the trade at its price
+        taker = repository.Proposal(
+            None, datetime.datetime.now(), trade.stock_ticker, shares, trade.price,
+            "SELLING" if trade.type == "BUYING" else "BUYING", None, user_id
+        )
 
-            ])
+        # Execute multiple queries to trade in p2p market: the trade's remaining amount is reduced, frozen cash or
+        # stocks of whoever proposed it are released for the traded shares only, and the trade is removed once filled
+        try:
+            with matching.engine.book(trade.stock_ticker) as book:
+                execute_transaction(matching.fill_statements(taker, [(trade, shares)]))
+                book.fill([(trade, shares)])
+        except TransactionError as e:
+            return apology(str(e), e.code)
+
+        flash("Sold!" if trade.type == "BUYING" else "Bought!")
+        return redirect(url_for("p2p", **request.args))
+
+    # Get user's filters for the board
+    ticker = request.args.get("ticker", "").strip().upper()
+    side = request.args.get("side", "")
+    sort = request.args.get("sort", "time")
+    if side not in ("", "BUYING", "SELLING") or sort not in repository.PROPOSAL_SORTS:
+        return apology("Invalid filter", 400)
+
+    # Continue after the cursor of the last trade on previous page
+    after = None
+    if request.args.get("after"):
+        try:
+            value, p2p_id = request.args["after"].rsplit(",", 1)
+            after = (datetime.datetime.fromisoformat(value).isoformat(" ") if sort == "time" else float(value), int(p2p_id))
+        except ValueError:
+            return apology("Invalid page", 400)
 
-            flash("Bought!")
-            return redirect("/p2p")
+    # Get one page of p2p trade proposals, one extra to know if there's a next page
+    p2p_trades = repository.list_proposals(P2P_PAGE_SIZE + 1, ticker=ticker, side=side, sort=sort, after=after)
+    next_cursor = None
+    if len(p2p_trades) > P2P_PAGE_SIZE:
+        p2p_trades = p2p_trades[:P2P_PAGE_SIZE]
+        next_cursor = ",".join(map(str, repository.proposal_cursor(p2p_trades[-1], sort)))
 
-    return render_template("p2p.html", p2p_trades=p2p_trades, user_id=user_id)
+    return render_template("p2p.html", p2p_trades=p2p_trades, user_id=user_id, ticker=ticker, side=side, sort=sort, next_cursor=next_cursor)
 
 
 @app.route("/propose", methods=["GET", "POST"])
@@ -732,12 +770,7 @@ def propose():
     user_id = session["user_id"]
 
     # Get all the stock user owns and the amounts owned
-    stocks_owned = execute_query(
-        """SELECT stock_ticker AS stock_owned, amount AS amount_owned
-        FROM stock_ownership
-        WHERE user_id = ? AND amount > 0""",
-        (user_id,)
-    )
+    stocks_owned = repository.list_holdings(user_id)
 
     # Do this if user accesses page with POST method
     if request.method == "POST":
@@ -747,7 +780,6 @@ def propose():
         price = request.form.get("price")
         type = request.form.get("type").upper()
         comment = request.form.get("comment")
-        print(user_id,  user_stock, amount, price, type, comment)
         
         # Check whether user provided a transaction type
         if not type:
@@ -756,83 +788,73 @@ def propose():
         if not user_stock:
             return apology("Must provide stock symbol", 400)
         
-        # Check whether user provided a positive number for amount
+        # Check whether user provided a positive number for amount, NaN and infinity aren't numbers of stocks
         try:
-            if float(amount) <= 0:
-                return apology("The number of stocks should be positive", 400)
+            amount = float(amount)
         except ValueError:
             return apology("The number of stocks should be a valid number", 400)
+        if not (math.isfinite(amount) and amount > 0):
+            return apology("The number of stocks should be positive", 400)
         
         # Check whether user provided a positive number for price
         try:
-            if float(price) <= 0:
-                return apology("The price should be positive", 400)
+            price = float(price)
         except ValueError:
             return apology("The price should be a valid number", 400)
+        if not (math.isfinite(price) and price > 0):
+            return apology("The price should be positive", 400)
         
         # Check whether comment is no longer than 200 characters
         if len(comment) > 200:
             return apology("Comment is too long", 400)
         
         if type == "BUYING":
-            
-            # Check whether user has enough money to propose this trade
-            if float(price) * float(amount) > execute_query("SELECT cash FROM users WHERE id = ?", (user_id,))[0]["cash"]:
-                return apology("You don't have enough cash to propose this trade", 400)
 
             # Check whether stock exists in yfinance
             quote = lookup(user_stock)
-            if quote['name'] == "Unknown": 
+            if not quote or quote['name'] == "Unknown": 
                 return apology("Stock doesn't exist", 400)
 
-            # Insert trade into p2p_market table
-            execute_query(
-                "INSERT INTO p2p_market (time_posted, stock_ticker, price, amount, type, comment, user_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (datetime.datetime.now(), user_stock, price, amount, type, comment, user_id)
-            )
-
-            # Freeze cash for the trade
-            execute_query(
-                "UPDATE users SET frozen_cash = frozen_cash + ?, cash = cash - ? WHERE id = ?",
-                (float(price) * float(amount), float(price) * float(amount), user_id)
-            )
-            
-            # Tell user that trade was proposed, redirect to p2p
-            flash("Trade proposed!")
-            return redirect("/p2p")
-            
-        if type == "SELLING":            
+            # Freeze cash for whatever part of the trade isn't matched right away, only if user has enough money to propose it
+            freeze = lambda shares: repository.freeze_cash(user_id, price * shares, "You don't have enough cash to propose this trade")
+
+        elif type == "SELLING":
 
             # Check whether stock ticker provided exists in user's owned stocks
-            stock_exists = False
-            amount_owned = 0
-            for stock in stocks_owned:
-                if stock["stock_owned"] == user_stock:
-                    stock_exists = True
-                    amount_owned = stock["amount_owned"]
-                    break
-            if stock_exists == False:
+            if not any(stock.stock_ticker == user_stock for stock in stocks_owned):
                 return apology("User doesn't own this stock", 400)
-            
-            # Check whether user owns this many stocks
-            if float(amount) > amount_owned:
-                return apology("You don't have enough stocks to sell", 400)
-
-            # Insert trade into p2p_market table
-            execute_query(
-                "INSERT INTO p2p_market (time_posted, stock_ticker, price, amount, type, comment, user_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (datetime.datetime.now(), user_stock, price, amount, type, comment, user_id)
-            )
-
-            # Freeze stocks for the trade
-            execute_query(
-                "UPDATE stock_ownership SET frozen_amount = frozen_amount + ?, amount = amount - ? WHERE user_id = ? AND stock_ticker = ?",
-                (amount, amount, user_id, user_stock)
-            )
-
-            # Tell user that trade was proposed, redirect to p2p
+
+            # Freeze stocks for whatever part of the trade isn't matched right away, only if user owns this many stocks
+            freeze = lambda shares: repository.freeze_shares(user_id, user_stock, shares, "You don't have enough stocks to sell")
+
+        else:
+            return apology("Invalid transaction type", 400)
+
+        # Trade with matching proposals already on the market first, best price first
+        taker = repository.Proposal(None, datetime.datetime.now(), user_stock, amount, price, type, comment, user_id)
+        try:
+            with matching.engine.book(user_stock) as book:
+                fills = book.match(taker)
+                remaining = matching.unfilled(taker, fills)
+                queries = matching.fill_statements(taker, fills)
+
+                # Insert the rest of the trade into p2p_market table
+                if remaining > 0:
+                    queries += [freeze(remaining), repository.insert_proposal(user_id, user_stock, remaining, price, type, comment)]
+
+                execute_transaction(queries)
+                book.fill(fills)
+        except TransactionError as e:
+            return apology(str(e), e.code)
+
+        # Tell user how the trade went, redirect to p2p
+        if not fills:
             flash("Trade proposed!")
-            return redirect("/p2p")
+        elif remaining > 0:
+            flash(f"Trade partially matched, {amount - remaining:g} shares traded and the rest proposed!")
+        else:
+            flash("Trade matched!")
+        return redirect("/p2p")
 
     return render_template("propose.html", stocks_owned=stocks_owned)
 
@@ -847,12 +869,7 @@ def managep2p():
     user_id = session["user_id"]
 
     # Get all the trade propositions made by user
-    p2p_trades = execute_query("SELECT * FROM p2p_market WHERE user_id = ?", (user_id,))
-
-    # Convert to datetime object
-    p2p_trades = [dict(p2p_trade) for p2p_trade in p2p_trades]
-    for p2p_trade in p2p_trades:
-        p2p_trade["time_posted"] = datetime.datetime.strptime(p2p_trade["time_posted"], "%Y-%m-%d %H:%M:%S.%f")
+    p2p_trades = repository.list_user_proposals(user_id)
 
     if request.method == "POST":
 
@@ -871,198 +888,146 @@ def managep2p():
         if not action:
             return apology("Invalid request", 400)
 
-        # Get trade details
-        trade = execute_query("SELECT * FROM p2p_market WHERE p2p_id = ?", (trade_id,))
-        trade = trade[0]
+        # Get trade details, users can only manage their own trade propositions
+        trade = repository.get_proposal(trade_id)
+        if not trade or trade.user_id != user_id:
+            return apology("This trade is no longer available", 400)
 
         # Do this if we want to remove a trade proposition
         if action == "remove":
 
             # Do this if trade is a buying trade
-            if trade["type"] == "BUYING":
-
-                
-                # Execute multiple queries to remove buying p2p proposal
-                execute_multiple_queries([
-
-                    # Remove frozen cash from user
-                    (
-                        "UPDATE users SET frozen_cash = frozen_cash - ? WHERE id = ?", 
-                        (trade["price"] * trade["amount"], user_id)
-                    ),
-
-                    # Add cash back to user
-                    (
-                        "UPDATE users SET cash = cash + ? WHERE id = ?", 
-                        (trade["price"] * trade["amount"], user_id)
-                    ),
-
-                    # Remove trade from p2p_market
-                    (
-                        "DELETE FROM p2p_market WHERE p2p_id = ?", 
-                        (trade_id,)
-                    )
-                
-                ])
+            if trade.type == "BUYING":
+
+                # Give frozen cash back to user
+                release = repository.unfreeze_cash(user_id, trade.price * trade.amount)
 
-                flash("Trade cancelled!")
-                return redirect("/managep2p")
-            
             # Do this if trade is a selling trade
-            if trade["type"] == "SELLING":
+            elif trade.type == "SELLING":
 
-                # Execute multiple queries to remove selling p2p proposal
-                execute_multiple_queries([
+                # Give frozen stocks back to user
+                release = repository.unfreeze_shares(user_id, trade.stock_ticker, trade.amount)
 
-                    # Remove frozen stocks from user
-                    (
-                        "UPDATE stock_ownership SET frozen_amount = frozen_amount - ? WHERE user_id = ? AND stock_ticker = ?", 
-                        (trade["amount"], user_id, trade["stock_ticker"])
-                    ),
+            # Execute multiple queries to remove p2p proposal
+            try:
+                execute_transaction([
 
-                    # Add stocks back to user
-                    (
-                        "UPDATE stock_ownership SET amount = amount + ? WHERE user_id = ? AND stock_ticker = ?", 
-                        (trade["amount"], user_id, trade["stock_ticker"])
-                    ),
+                    # Remove trade from p2p_market, only if it wasn't accepted in the meantime
+                    repository.claim_proposal(trade, "This trade is no longer available"),
 
-                    # Remove trade from p2p_market
-                    (
-                        "DELETE FROM p2p_market WHERE p2p_id = ?", 
-                        (trade_id,)
-                    )
+                    release
 
                 ])
+            except TransactionError as e:
+                return apology(str(e), e.code)
+            matching.engine.discard(trade.stock_ticker, trade.p2p_id)
 
-                flash("Trade cancelled!")
-                return redirect("/managep2p")
+            flash("Trade cancelled!")
+            return redirect("/managep2p")
 
         if action == "edit":
 
             # Get user inputs from updated trade proposition
-            trade_id = request.form.get("trade_id")
             new_amount = request.form.get("amount")
             new_price = request.form.get("price")
             new_comment = request.form.get("comment")
-            print(request.form)
 
-            # Check whether user provided a positive number for amount 
+            # Check whether user provided a positive number for amount, NaN and infinity aren't numbers of stocks
             try:
-                if float(new_amount) <= 0:
-                    return apology("The number of stocks should be positive", 400)
+                new_amount = float(new_amount)
             except ValueError:
                 return apology("The number of stocks should be a valid number", 400)
+            if not (math.isfinite(new_amount) and new_amount > 0):
+                return apology("The number of stocks should be positive", 400)
             
             # Check whether user provided a positive number for price
             try:
-                if float(new_price) <= 0:
-                    return apology("The price should be positive", 400)
+                new_price = float(new_price)
             except ValueError:
                 return apology("The price should be a valid number", 400)
+            if not (math.isfinite(new_price) and new_price > 0):
+                return apology("The price should be positive", 400)
             
             # Check whether comment is no longer than 200 characters
             if len(new_comment) > 200:
                 return apology("Comment is too long", 400)
-            
-            if trade["type"] == "BUYING":
-
-                # Get user's available cash and currently frozen cash
-                user = execute_query("SELECT cash, frozen_cash FROM users WHERE id = ?", (user_id,))[0]
-                
-                # Calculate the old frozen cash for this trade
-                old_frozen_cash = float(trade["price"]) * float(trade["amount"])
-                
-                # Calculate the new frozen cash
-                new_frozen_cash = float(new_price) * float(new_amount)
-                
-                # Calculate the effective available cash after unfreezing the old amount
-                effective_cash = user["cash"] + old_frozen_cash
-
-                # Check whether the user has enough cash for the new trade
-                if new_frozen_cash > effective_cash:
-                    return apology("You don't have enough cash to propose this trade", 400)
-
-                # Check whether stock exists in yfinance
-                quote = lookup(trade["stock_ticker"])
-                if quote['name'] == "Unknown": 
-                    return apology("Stock doesn't exist", 400)
-
-                # Execute multiple queries to edit buying p2p proposal
-                execute_multiple_queries([
-
-                    # Update trade in p2p_market table
-                    (
-                        "UPDATE p2p_market SET price = ?, amount = ?, comment = ? WHERE p2p_id = ?",
-                        (new_price, new_amount, new_comment, trade_id)
-                    ),
-
-                    # Adjust frozen cash properly
-                    (
-                        "UPDATE users SET frozen_cash = frozen_cash - ? + ?, cash = cash + ? - ? WHERE id = ?",
-                        (old_frozen_cash, new_frozen_cash, old_frozen_cash, new_frozen_cash, user_id)
-                    )
 
-                ])
+            # Check whether stock exists in yfinance
+            quote = lookup(trade.stock_ticker)
+            if not quote or quote['name'] == "Unknown": 
+                return apology("Stock doesn't exist", 400)
+            
+            if trade.type == "BUYING":
 
-                flash("Trade updated!")
-                return redirect("/managep2p")
+                # Adjust frozen cash properly, only if user can cover the new trade after unfreezing the old amount
+                refreeze = repository.refreeze_cash(
+                    user_id, trade.price * trade.amount, new_price * new_amount,
+                    "You don't have enough cash to propose this trade"
+                )
             
-            if trade["type"] == "SELLING":
-
-                # Get user's stock ownership
-                stock = execute_query(
-                    "SELECT amount, frozen_amount FROM stock_ownership WHERE user_id = ? AND stock_ticker = ?",
-                    (user_id, trade["stock_ticker"])
-                )[0]
-
-                # Check if user owns the stock
-                if not stock:
-                    return apology("You don't own this stock", 400)
-                
-                # Old trade's frozen amount
-                old_frozen_amount = float(trade["amount"])  
-                # New trade's frozen amount
-                new_frozen_amount = float(new_amount)  
-
-                # Calculate effective available stock after unfreezing the old amount
-                effective_stock = stock["amount"] + old_frozen_amount
-
-                # Check whether the user has enough stock to propose this new trade
-                if new_frozen_amount > effective_stock:
-                    return apology("You don't have enough stock to propose this trade", 400)
-
-                # Check whether stock exists in yfinance
-                quote = lookup(trade["stock_ticker"])
-                if quote['name'] == "Unknown": 
-                    return apology("Stock doesn't exist", 400)
-
-                # Execute multiple queries to edit selling p2p proposal
-                execute_multiple_queries([
-
-                    # Update trade in p2p_market table
-                    (
-                        "UPDATE p2p_market SET price = ?, amount = ?, comment = ? WHERE p2p_id = ?",
-                        (new_price, new_amount, new_comment, trade_id)
-                    ),
-
-                    # Adjust frozen stock properly
-                    (
-                        "UPDATE stock_ownership SET frozen_amount = frozen_amount - ? + ? WHERE user_id = ? AND stock_ticker = ?",
-                        (old_frozen_amount, new_frozen_amount, user_id, trade["stock_ticker"])
-                    )
+            elif trade.type == "SELLING":
 
-                ])
+                # Adjust frozen stock properly, only if user can cover the new trade after unfreezing the old amount
+                refreeze = repository.refreeze_shares(
+                    user_id, trade.stock_ticker, trade.amount, new_amount,
+                    "You don't have enough stock to propose this trade"
+                )
+
+            # Edited trade may now match proposals already on the market
+            taker = replace(trade, amount=new_amount, price=new_price, comment=new_comment)
+
+            # Execute multiple queries to edit p2p proposal
+            try:
+                with matching.engine.book(trade.stock_ticker) as book:
+                    fills = book.match(taker)
+                    execute_transaction([
+
+                        # Update trade in p2p_market table, only if it wasn't accepted in the meantime
+                        repository.update_proposal(trade, taker.amount, taker.price, new_comment, "This trade is no longer available"),
+
+                        refreeze
+
+                    ] + matching.fill_statements(taker, fills))
 
-                flash("Trade updated!")
-                return redirect("/managep2p")     
+                    book.fill(fills)
+                    remaining = matching.unfilled(taker, fills)
+                    if remaining > 0:
+                        book.add(replace(taker, amount=remaining))
+                    else:
+                        book.discard(taker.p2p_id)
+            except TransactionError as e:
+                return apology(str(e), e.code)
+
+            flash("Trade updated!" if not fills else "Trade updated and matched!")
+            return redirect("/managep2p")
 
     return render_template("managep2p.html", p2p_trades=p2p_trades)
 
 
 @app.route("/quote_json", methods=["GET"])
+# Buy and sell pages poll here every STREAM_INTERVAL seconds when price streaming is off
+@limiter.limit("120 per minute")
 @login_required
 def quote_json():
-    """Return stock price as JSON"""
+    """Return stock price as JSON, or prices of several comma separated symbols"""
+    if "symbols" in request.args:
+        symbols = list(dict.fromkeys(symbol.strip().upper() for symbol in request.args["symbols"].split(",") if symbol.strip()))
+
+        if not symbols:
+            return jsonify({"error": "Missing stock symbols"}), 400
+
+        if len(symbols) > MAX_QUOTE_SYMBOLS:
+            return jsonify({"error": "Too many stock symbols"}), 400
+
+        prices, stale = lookup_many(symbols)
+
+        response = jsonify({
+            "prices": prices,
+            "stale": sorted(stale),
+            "missing": [symbol for symbol in symbols if symbol not in prices]
+        })
+        return cacheable_quote_response(response, symbols, fresh=not stale)
+
     symbol = request.args.get("symbol", "").upper()
     
     if not symbol:
@@ -1073,7 +1038,87 @@ def quote_json():
     if not stock or stock["name"] == "Unknown":
         return jsonify({"error": "Stock not found"}), 404
 
-    return jsonify({"price": stock["price"]})
+    return cacheable_quote_response(jsonify({"price": stock["price"]}), [symbol])
+
+
+def cacheable_quote_response(response, symbols, fresh=True):
+    """Let browsers and proxies reuse price JSON for as long as the quote cache would"""
+    if fresh:
+        response.cache_control.public = True
+        response.cache_control.max_age = int(QUOTE_CACHE_TTL)
+    else:
+        response.cache_control.no_cache = True
+
+    updated_at = quotes_updated_at(symbols)
+    if updated_at:
+        response.last_modified = updated_at
+
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@app.route("/quote_stream", methods=["GET"])
+@login_required
+def quote_stream():
+    """Stream stock prices as Server-Sent Events"""
+    if not PRICE_STREAMING:
+        return jsonify({"error": "Price streaming is turned off, use /quote_json"}), 404
+
+    symbols = list(dict.fromkeys(symbol.strip().upper() for symbol in request.args.get("symbols", "").split(",") if symbol.strip()))
+
+    if not symbols:
+        return jsonify({"error": "Missing stock symbols"}), 400
+
+    if len(symbols) > STREAM_MAX_SYMBOLS:
+        return jsonify({"error": "Too many stock symbols"}), 400
+
+    response = app.response_class(price_feed.events(symbols), mimetype="text/event-stream")
+    # Stop reverse proxies from buffering the stream
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@app.route("/chart_json", methods=["GET"])
+# Every quoted stock loads its chart, so charts get a limit of their own instead of counting towards the hourly one
+@limiter.limit("60 per minute")
+@login_required
+def chart_json():
+    """Return stock chart as Plotly figure JSON"""
+    symbol = request.args.get("symbol", "").upper()
+    period = request.args.get("period", "3mo")
+
+    if not symbol:
+        return jsonify({"error": "Missing stock symbol"}), 400
+
+    if period not in CHART_PERIODS:
+        return jsonify({"error": "Invalid period"}), 400
+
+    chart = get_stock_chart(symbol, period)
+
+    if not chart:
+        return jsonify({"error": "Stock not found"}), 404
+
+    return app.response_class(chart, mimetype="application/json")
+
+
+@app.route("/metrics")
+@limiter.exempt
+def prometheus_metrics():
+    """Expose request timing histograms per endpoint in the Prometheus text format"""
+    if metrics.METRICS_TOKEN and not secrets.compare_digest(request.headers.get("Authorization", ""), f"Bearer {metrics.METRICS_TOKEN}"):
+        return "Unauthorized\n", 401, {"Content-Type": "text/plain; charset=utf-8", "WWW-Authenticate": "Bearer"}
+
+    return metrics.expose(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+@app.route("/js/plotly-<version>.min.js")
+@limiter.exempt
+def plotly_js(version):
+    """Serve plotly.js bundled with the plotly package, cacheable for a year"""
+    return send_from_directory(PLOTLY_JS_DIR, "plotly.min.js", max_age=365 * 24 * 60 * 60)
+
+
+startup.report()
 
 
 if __name__ == "__main__":
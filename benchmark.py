@@ -0,0 +1,201 @@
+"""
+Route latency benchmark.
+
+Generates a temporary database at each dataset scale, logs in through the Flask test client and times the main
+routes with quotes and charts stubbed out, so results don't depend on the network. Latency percentiles and
+throughput per route are printed as JSON, and can be compared against a previous run to catch regressions:
+
+    python benchmark.py --scales small medium --output before.json
+    python benchmark.py --scales small medium --baseline before.json
+"""
+import argparse
+import importlib
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from database import DATABASE, close_pool, connect
+from generate import TICKERS, generate
+from providers import SyntheticProvider
+
+# Dataset sizes, passed on to generate.generate
+SCALES = {
+    "small": {"users": 100, "holdings": 5, "market_transactions": 5000, "p2p_transactions": 1250, "proposals": 200},
+    "medium": {"users": 1000, "holdings": 15, "market_transactions": 200_000, "p2p_transactions": 50_000, "proposals": 5000},
+    "large": {"users": 10_000, "holdings": 30, "market_transactions": 2_000_000, "p2p_transactions": 500_000, "proposals": 50_000},
+}
+
+# The benchmarked user is the first one generated, who also trades the most
+USER_ID = 1
+
+# Prices of the generated market, without any delay
+provider = SyntheticProvider(latency=0)
+
+
+def stub_lookup(symbol):
+    return provider.get_quote(symbol)
+
+
+def stub_lookup_many(symbols, deadline=None):
+    return provider.get_prices([symbol.upper() for symbol in symbols]), set()
+
+
+def stub_get_stock_chart(symbol, period="3mo"):
+    return "{}"
+
+
+def load_app():
+    """Import the application with stubbed quotes and charts and rate limits turned off."""
+    module = importlib.import_module("app")
+    module.lookup = stub_lookup
+    module.lookup_many = stub_lookup_many
+    module.get_stock_chart = stub_get_stock_chart
+    module.limiter.enabled = False
+    return module
+
+
+def routes(client):
+    """Return (name, request) pairs of the benchmarked routes, each request returning a response."""
+    # Trade shares of a stock the user already holds, so the dataset stays the same size
+    conn = connect()
+    try:
+        ticker = conn.execute("SELECT stock_ticker FROM stock_ownership WHERE user_id = ? ORDER BY amount DESC", (USER_ID,)).fetchone()[0]
+
+        # An own bid far below the market to edit back and forth
+        client.post("/propose", data={"symbol": ticker, "shares": "1", "price": "0.01", "type": "BUYING", "comment": ""})
+        trade_id = conn.execute("SELECT MAX(p2p_id) FROM p2p_market WHERE user_id = ?", (USER_ID,)).fetchone()[0]
+    finally:
+        conn.close()
+    edits = iter(range(sys.maxsize))
+
+    return [
+        ("GET /", lambda: client.get("/")),
+        ("POST /buy", lambda: client.post("/buy", data={"symbol": ticker, "shares": "0.01"})),
+        ("POST /sell", lambda: client.post("/sell", data={"symbol": ticker, "shares": "0.01"})),
+        ("GET /history", lambda: client.get("/history")),
+        ("GET /p2p", lambda: client.get("/p2p")),
+        ("GET /p2p?sort=price_asc", lambda: client.get("/p2p", query_string={"sort": "price_asc", "side": "SELLING"})),
+        ("POST /propose", lambda: client.post("/propose", data={"symbol": ticker, "shares": "1", "price": "0.01", "type": "BUYING", "comment": ""})),
+        ("GET /managep2p", lambda: client.get("/managep2p")),
+        ("POST /managep2p", lambda: client.post("/managep2p", data={
+            "trade_id": trade_id, "action": "edit", "amount": str(1 + next(edits) % 2), "price": "0.01", "comment": ""
+        })),
+        ("GET /quote_json", lambda: client.get("/quote_json", query_string={"symbol": ticker})),
+        ("GET /quote_json?symbols", lambda: client.get("/quote_json", query_string={"symbols": ",".join(TICKERS[:20])})),
+    ]
+
+
+def measure(request, requests, warmup):
+    """Time requests calls of request after warmup untimed ones."""
+    for _ in range(warmup):
+        request()
+
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = request()
+        latencies.append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            errors += 1
+    elapsed = time.perf_counter() - started
+
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "requests": requests,
+        "errors": errors,
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+        "p50_ms": round(percentiles[49] * 1000, 3),
+        "p95_ms": round(percentiles[94] * 1000, 3),
+        "p99_ms": round(percentiles[98] * 1000, 3),
+        "throughput_rps": round(requests / elapsed, 1),
+    }
+
+
+def run(scales, requests, warmup, directory):
+    """Benchmark every route at each scale and return the results."""
+    results = {
+        "python": platform.python_version(),
+        "requests": requests,
+        "scales": {},
+    }
+    for name in scales:
+        # Each scale gets its own database file, the application finds it in the working directory
+        path = os.path.join(directory, name)
+        os.makedirs(path)
+        os.chdir(path)
+        close_pool()
+
+        start = time.perf_counter()
+        generate(DATABASE, **SCALES[name])
+        seeded = time.perf_counter() - start
+
+        module = load_app()
+        module.matching.engine.books.clear()
+        client = module.app.test_client()
+        with client.session_transaction() as session:
+            session["user_id"] = USER_ID
+
+        print(f"Benchmarking {name} dataset (seeded in {seeded:.1f}s)", file=sys.stderr)
+        scale = results["scales"][name] = {"dataset": SCALES[name], "seed_seconds": round(seeded, 2), "routes": {}}
+        for route, request in routes(client):
+            scale["routes"][route] = measure(request, requests, warmup)
+            print(f"  {route:<24} p50 {scale['routes'][route]['p50_ms']:8.2f} ms  p95 {scale['routes'][route]['p95_ms']:8.2f} ms", file=sys.stderr)
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    """Return descriptions of routes whose p95 latency grew by more than tolerance compared to baseline."""
+    found = []
+    for name, scale in results["scales"].items():
+        for route, stats in scale["routes"].items():
+            before = baseline.get("scales", {}).get(name, {}).get("routes", {}).get(route)
+            if before and stats["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+                found.append(f"{name} {route}: p95 {before['p95_ms']} ms -> {stats['p95_ms']} ms")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark route latency at several dataset scales.")
+    parser.add_argument("--scales", nargs="+", choices=SCALES, default=["small", "medium"], help="dataset scales to run (default: small medium)")
+    parser.add_argument("--requests", type=int, default=200, help="timed requests per route (default: 200)")
+    parser.add_argument("--warmup", type=int, default=20, help="untimed requests per route first (default: 20)")
+    parser.add_argument("--output", help="write results to this file instead of standard output")
+    parser.add_argument("--baseline", help="results of an earlier run to compare p95 latencies against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p95 growth over baseline (default: 0.2)")
+    args = parser.parse_args()
+    if args.requests < 2:
+        parser.error("--requests must be at least 2")
+    if os.path.dirname(DATABASE):
+        parser.error("DATABASE must be unset or a plain file name, the benchmark creates its own databases")
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="mockstocks-benchmark-") as directory:
+        try:
+            results = run(args.scales, args.requests, args.warmup, directory)
+        finally:
+            close_pool()
+            os.chdir(cwd)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if baseline:
+        with open(baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for regression in found:
+            print(f"Regression: {regression}", file=sys.stderr)
+        sys.exit(1 if found else 0)
+
+
+if __name__ == "__main__":
+    main()
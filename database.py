@@ -1,66 +1,161 @@
+import os
+import queue
+import random
 import sqlite3
+import time
+from contextlib import closing
 from flask import g
+from metrics import timed
+
+# Database file, e.g. one built by generate.py for scale testing
+DATABASE = os.environ.get("DATABASE", "mockstocks.db")
+
+# Bump whenever the schema script in initialize_database changes, so existing databases run it again
+SCHEMA_VERSION = 2
+
+# Number of idle connections kept open for reuse between requests
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 16))
+
+# Milliseconds a statement waits for another connection's lock before failing
+DB_BUSY_TIMEOUT = 5000
+
+# Pragmas applied to every connection
+PRAGMAS = (
+    # Readers don't block on writers (and vice versa) in WAL mode, fsync only at checkpoints
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    # Wait for locks instead of failing immediately with "database is locked"
+    f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT}",
+    # 20 MB page cache, 256 MB memory-mapped I/O, temporary tables and indexes in memory
+    "PRAGMA cache_size = -20000",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA temp_store = MEMORY",
+)
+
+# How many times a transaction is retried when the database is busy, and the first backoff in seconds
+DB_RETRIES = int(os.environ.get("DB_RETRIES", 5))
+DB_RETRY_BACKOFF = float(os.environ.get("DB_RETRY_BACKOFF", 0.05))
+
+# Idle connections shared by all request threads
+_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+
+def connect(database=DATABASE):
+    """Open a new tuned database connection."""
+    # Statements are cached per connection by their SQL text, so repeated queries skip re-preparing
+    conn = sqlite3.connect(database, check_same_thread=False, cached_statements=256)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
 
-DATABASE = "mockstocks.db"
 
 def get_db_connection():
-    """Open a new database connection per request."""
+    """Get a pooled database connection for the current request."""
     if "db" not in g:
-        g.db = sqlite3.connect(DATABASE)
-        g.db.row_factory = sqlite3.Row  # Makes rows return as dictionaries
+        try:
+            g.db = _pool.get_nowait()
+        except queue.Empty:
+            g.db = connect()
     return g.db
 
 def close_db(exception=None):
-    """Close the database connection at the end of the request."""
+    """Return the database connection to the pool at the end of the request."""
     db = g.pop("db", None)
     if db is not None:
-        db.close()
+        # Never hand a connection with a half-finished transaction to the next request
+        if db.in_transaction:
+            db.rollback()
+        try:
+            _pool.put_nowait(db)
+        except queue.Full:
+            db.close()
+
+def close_pool():
+    """Close all idle pooled connections, e.g. after the database file was replaced."""
+    while True:
+        try:
+            _pool.get_nowait().close()
+        except queue.Empty:
+            return
 
+@timed("db")
 def execute_query(query, params=(), fetchone=False):
-    """Execute a query and return results as a list of dictionaries."""
-    db = get_db_connection()
-    try:
-        cursor = db.execute(query, params)
+    """Execute a read query and return all rows as tuples, or only the first row (None if there is none)."""
+    cursor = get_db_connection().execute(query, params)
+    return cursor.fetchone() if fetchone else cursor.fetchall()
+
+
+class TransactionError(Exception):
+    """Raised when a transaction is rejected or can't be completed, with a message for the user."""
+
+    def __init__(self, message, code=400):
+        super().__init__(message)
+        self.code = code
 
-        # Auto-commit for data-modifying queries
-        if query.strip().upper().startswith(("INSERT", "UPDATE", "DELETE")):
+
+def _is_busy(error):
+    """Whether error means another connection holds the write lock."""
+    return isinstance(error, sqlite3.OperationalError) and (
+        getattr(error, "sqlite_errorname", None) in ("SQLITE_BUSY", "SQLITE_LOCKED") or "locked" in str(error)
+    )
+
+
+@timed("db")
+def execute_transaction(queries, retries=DB_RETRIES):
+    """
+    Execute queries as one atomic BEGIN IMMEDIATE transaction, retrying with backoff while the database is busy.
+    queries: List of tuples (query, params) or (query, params, error_message).
+    When error_message is given the statement is a guard: if it changes no rows the whole
+    transaction is rolled back and TransactionError(error_message) is raised. error_message may also be
+    a TransactionError instance, which is raised as it is so callers can tell guards apart by type.
+    """
+    db = get_db_connection()
+    for attempt in range(retries + 1):
+        try:
+            # Take the write lock up front so guards and writes see a consistent state
+            db.execute("BEGIN IMMEDIATE")
+            for query, params, *error_message in queries:
+                cursor = db.execute(query, params)
+                if error_message and cursor.rowcount == 0:
+                    error = error_message[0]
+                    raise error if isinstance(error, TransactionError) else TransactionError(error)
             db.commit()
+            return True
+        except TransactionError:
+            db.rollback()
+            raise
+        except sqlite3.Error as e:
+            if db.in_transaction:
+                db.rollback()
+            if not _is_busy(e) or attempt == retries:
+                print(f"Transaction failed: {e}")
+                raise TransactionError("Could not complete transaction, please try again", 503)
+            time.sleep(DB_RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
 
-        # Always return a list, even if fetching one result
-        if fetchone:
-            result = cursor.fetchone()
-            return [result] if result else []  # Wrap in a list if not None
-        else:
-            return cursor.fetchall()  # Already a list
-    except sqlite3.Error as e:
-        print(f"Database error: {e}")
-        return []  # Return an empty list on error
-    finally:
-        cursor.close()  # Always close the cursor
 
-def execute_multiple_queries(queries):
+def try_transaction(queries):
     """
-    Execute multiple queries as an atomic transaction.
-    queries: List of tuples (query, params)
-    Returns True if successful, False if rollback occurs.
+    Execute queries as one transaction only if the write lock is free right now, without waiting or retrying.
+    Meant for optional writes on read pages, which shouldn't wait behind trades. Returns whether the queries ran.
     """
     db = get_db_connection()
+    db.execute("PRAGMA busy_timeout = 0")
     try:
-        cursor = db.cursor()
-        for query, params in queries:
-            cursor.execute(query, params)
-        db.commit()  # Commit all queries together
-        return True
-    except sqlite3.Error as e:
-        db.rollback()  # Roll back all queries if any fail
-        print(f"Transaction failed: {e}")
+        return execute_transaction(queries, retries=0)
+    except TransactionError as e:
+        print(f"Skipped optional write: {e}")
         return False
     finally:
-        cursor.close()
+        db.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT}")
+
+
+def initialize_database(database=DATABASE):
+    """Ensure required tables exist in the database, skipping the schema script if it already ran for this version."""
+    # Commit the schema and close the connection right away, so the database isn't held open until garbage collection
+    with closing(connect(database)) as conn, conn:
+        if conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION:
+            return
 
-def initialize_database():
-    """Ensure required tables exist in the database."""
-    with sqlite3.connect(DATABASE) as conn:
         db = conn.cursor()
 
         db.executescript("""
@@ -120,6 +215,56 @@ def initialize_database():
             FOREIGN KEY (seller_id) REFERENCES users(id)
         );
 
+        CREATE TABLE IF NOT EXISTS prices (
+            ticker TEXT PRIMARY KEY NOT NULL,
+            name TEXT,
+            price REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS price_history (
+            ticker TEXT NOT NULL,
+            date TEXT NOT NULL,
+            open REAL,
+            high REAL,
+            low REAL,
+            close REAL NOT NULL,
+            volume INTEGER,
+            PRIMARY KEY (ticker, date)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS price_demand (
+            ticker TEXT PRIMARY KEY NOT NULL,
+            requested_at REAL NOT NULL
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY NOT NULL,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS portfolio_summary (
+            user_id INTEGER PRIMARY KEY NOT NULL,
+            cost_basis REAL NOT NULL DEFAULT 0,
+            shares REAL NOT NULL DEFAULT 0,
+            last_valuation REAL,
+            valued_at DATETIME,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        );
+
+        CREATE TABLE IF NOT EXISTS sessions (
+            sid TEXT PRIMARY KEY NOT NULL,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID;
+
+        -- Backfill summaries for users who traded before the table existed
+        INSERT OR IGNORE INTO portfolio_summary (user_id, cost_basis, shares)
+        SELECT user_id, SUM(avg_price * (amount + frozen_amount)), SUM(amount + frozen_amount)
+        FROM stock_ownership
+        GROUP BY user_id;
+
         -- Users table: Ensure quick lookup by username and ID
         CREATE UNIQUE INDEX IF NOT EXISTS idx_username ON users (username);
         CREATE INDEX IF NOT EXISTS idx_user_id ON users (id);
@@ -129,7 +274,7 @@ def initialize_database():
         CREATE INDEX IF NOT EXISTS idx_stock_ownership_ticker ON stock_ownership (stock_ticker);
 
         -- Market Transactions: Indexes for searching transactions by user and stock
-        CREATE INDEX IF NOT EXISTS idx_market_transactions_user ON market_transactions (user_id);
+        CREATE INDEX IF NOT EXISTS idx_market_transactions_user_time ON market_transactions (user_id, time_transacted);
         CREATE INDEX IF NOT EXISTS idx_market_transactions_ticker ON market_transactions (stock_ticker);
         CREATE INDEX IF NOT EXISTS idx_market_transactions_time ON market_transactions (time_transacted);
 
@@ -137,14 +282,26 @@ def initialize_database():
         CREATE INDEX IF NOT EXISTS idx_p2p_market_user ON p2p_market (user_id);
         CREATE INDEX IF NOT EXISTS idx_p2p_market_ticker ON p2p_market (stock_ticker);
         CREATE INDEX IF NOT EXISTS idx_p2p_market_time ON p2p_market (time_posted);
+        CREATE INDEX IF NOT EXISTS idx_p2p_market_ticker_type_price ON p2p_market (stock_ticker, type, price);
+        CREATE INDEX IF NOT EXISTS idx_p2p_market_type_price ON p2p_market (type, price);
+        CREATE INDEX IF NOT EXISTS idx_p2p_market_price ON p2p_market (price);
 
-        -- P2P Transactions: Indexing buyer and seller for fast retrieval
-        CREATE INDEX IF NOT EXISTS idx_p2p_transactions_buyer ON p2p_transactions (buyer_id);
-        CREATE INDEX IF NOT EXISTS idx_p2p_transactions_seller ON p2p_transactions (seller_id);
+        -- P2P Transactions: Indexing buyer and seller with time for paginated history
+        CREATE INDEX IF NOT EXISTS idx_p2p_transactions_buyer_time ON p2p_transactions (buyer_id, time_transacted);
+        CREATE INDEX IF NOT EXISTS idx_p2p_transactions_seller_time ON p2p_transactions (seller_id, time_transacted);
         CREATE INDEX IF NOT EXISTS idx_p2p_transactions_ticker ON p2p_transactions (stock_ticker);
         CREATE INDEX IF NOT EXISTS idx_p2p_transactions_time ON p2p_transactions (time_transacted);
+
+        -- Sessions: Bulk purge of expired sessions
+        CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at);
+
+        -- Single column user indexes superseded by the (user, time) indexes above
+        DROP INDEX IF EXISTS idx_market_transactions_user;
+        DROP INDEX IF EXISTS idx_p2p_transactions_buyer;
+        DROP INDEX IF EXISTS idx_p2p_transactions_seller;
                          
         """)
 
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
         conn.commit()
          
\ No newline at end of file
@@ -0,0 +1,206 @@
+"""
+Synthetic database generator for scale testing.
+
+Builds a new database with users, holdings, market and P2P transaction history and open P2P proposals, e.g.
+
+    python generate.py synthetic.db --users 100000 --market-transactions 8000000 --p2p-transactions 2000000
+
+Prices follow the synthetic quote provider, so QUOTE_PROVIDER=synthetic DATABASE=synthetic.db serves a consistent
+market: history trades at that day's price, bids rest below and asks above the current price, and the frozen cash
+and shares of every user match their open proposals. Holdings aren't derived from the transaction history.
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+from itertools import islice
+from werkzeug.security import generate_password_hash
+from database import connect, initialize_database
+from providers import SyntheticProvider
+
+# Tickers held and traded in generated databases
+TICKERS = """
+AAPL MSFT NVDA AMZN GOOGL META TSLA AVGO JPM LLY V UNH XOM MA COST HD PG JNJ WMT NFLX ABBV CRM BAC ORCL CVX
+MRK KO AMD PEP ADBE TMO LIN ACN MCD CSCO ABT WFC IBM GE DHR PM INTU QCOM TXN CAT VZ AMGN ISRG NOW DIS NEE
+PFE SPGI RTX GS AMAT UBER CMCSA T LOW HON UNP BKNG AXP PGR BLK SYK ETN TJX ELV BSX VRTX C LMT SCHW MDT ADP
+MU REGN PLD CB BA MMC ADI DE LRCX PANW SBUX KLAC BMY GILD NKE MDLZ SO ANET CI INTC SHOP PYPL ABNB SNOW COIN
+""".split()
+
+# Password of every generated user
+PASSWORD = "password"
+
+# Rows inserted per executemany call and committed together
+BATCH_SIZE = 500_000
+
+# Tables whose indexes are dropped while loading and built again afterwards, which is much faster than updating them row by row
+BULK_TABLES = ("stock_ownership", "market_transactions", "p2p_market", "p2p_transactions")
+
+
+def generate(database, users=1000, holdings=10, market_transactions=100_000, p2p_transactions=25_000, proposals=2000,
+             days=365, seed=0, batch_size=BATCH_SIZE, verbose=False):
+    """Create database filled with synthetic data, which must not exist yet. Returns the number of rows per table."""
+    if os.path.exists(database):
+        raise FileExistsError(f"{database} already exists")
+    rng = random.Random(seed)
+
+    def log(message):
+        if verbose:
+            print(message, file=sys.stderr)
+
+    # Daily closes of every ticker over the last days, on the same trading days for all of them
+    start = (datetime.date.today() - datetime.timedelta(days=days)).isoformat()
+    bars = {ticker: SyntheticProvider(latency=0).get_history(ticker, start=start) for ticker in TICKERS}
+    dates = [bar["date"] for bar in bars[TICKERS[0]]]
+    closes = {ticker: [bar["close"] for bar in history] for ticker, history in bars.items()}
+    price = lambda ticker: closes[ticker][-1]
+
+    # user_id -> [cash, frozen_cash] and (user_id, ticker) -> [amount, frozen_amount, avg_price]
+    balances = {user_id: [round(rng.uniform(1000, 100_000), 2), 0.0] for user_id in range(1, users + 1)}
+    owned = {}
+    for user_id in balances:
+        for ticker in rng.sample(TICKERS, min(len(TICKERS), rng.randint(1, 2 * holdings - 1))):
+            owned[user_id, ticker] = [float(rng.randint(1, 500)), 0.0, rng.choice(closes[ticker])]
+    held = list(owned)
+
+    # Open proposals freeze the cash or shares they offer, proposals nobody could cover are skipped
+    market = []
+    for _ in range(proposals):
+        if rng.random() < 0.5:
+            user_id, ticker = rng.choice(held)
+            amount = float(min(rng.randint(1, 20), owned[user_id, ticker][0]))
+            if not amount:
+                continue
+            owned[user_id, ticker][0] -= amount
+            owned[user_id, ticker][1] += amount
+            market.append((ticker, amount, round(price(ticker) * rng.uniform(1.01, 1.3), 2), "SELLING", user_id))
+        else:
+            user_id, ticker = rng.randint(1, users), rng.choice(TICKERS)
+            amount = float(rng.randint(1, 20))
+            bid = round(price(ticker) * rng.uniform(0.7, 0.99), 2)
+            if bid * amount > balances[user_id][0]:
+                continue
+            balances[user_id][0] -= bid * amount
+            balances[user_id][1] += bid * amount
+            market.append((ticker, amount, bid, "BUYING", user_id))
+
+    # Proposals were posted over the last month, oldest first
+    now = datetime.datetime.now()
+    posted = sorted(now - datetime.timedelta(seconds=rng.randint(0, 30 * 86400)) for _ in market)
+    market = [(time_posted.isoformat(" ", "seconds"), *proposal, "") for time_posted, proposal in zip(posted, market)]
+
+    # Busier users trade more: user 1 the most, then fewer and fewer
+    trader = lambda: 1 + int(users * rng.random() ** 2)
+
+    def history(total):
+        """Yield (time, day index) of total trades spread over the trading days, in time order like real inserts."""
+        for day, date in enumerate(dates):
+            count = total * (day + 1) // len(dates) - total * day // len(dates)
+            for second in sorted(rng.randrange(9 * 3600, 17 * 3600) for _ in range(count)):
+                yield f"{date} {second // 3600:02d}:{second // 60 % 60:02d}:{second % 60:02d}", day
+
+    def market_rows():
+        for time_transacted, day in history(market_transactions):
+            ticker = rng.choice(TICKERS)
+            yield (time_transacted, ticker, float(rng.randint(1, 100)), closes[ticker][day], "BUY" if rng.random() < 0.55 else "SELL", trader())
+
+    def p2p_rows():
+        for time_transacted, day in history(p2p_transactions):
+            ticker = rng.choice(TICKERS)
+            buyer, seller = trader(), trader()
+            if buyer == seller:
+                seller = seller % users + 1
+            yield (time_transacted, buyer, seller, ticker, float(rng.randint(1, 50)), round(closes[ticker][day] * rng.uniform(0.97, 1.03), 2))
+
+    passhash = generate_password_hash(PASSWORD)
+    tables = [
+        ("users", "INSERT INTO users (id, username, hash, cash, frozen_cash) VALUES (?, ?, ?, ?, ?)",
+         ((user_id, f"user{user_id}", passhash, round(cash, 2), round(frozen, 2)) for user_id, (cash, frozen) in balances.items())),
+        ("stock_ownership", "INSERT INTO stock_ownership (user_id, stock_ticker, amount, frozen_amount, avg_price) VALUES (?, ?, ?, ?, ?)",
+         ((*key, *holding) for key, holding in owned.items())),
+        ("p2p_market", "INSERT INTO p2p_market (time_posted, stock_ticker, amount, price, type, user_id, comment) VALUES (?, ?, ?, ?, ?, ?, ?)",
+         iter(market)),
+        ("market_transactions", "INSERT INTO market_transactions (time_transacted, stock_ticker, shares, price_per_share, type, user_id) VALUES (?, ?, ?, ?, ?, ?)",
+         market_rows()),
+        ("p2p_transactions", "INSERT INTO p2p_transactions (time_transacted, buyer_id, seller_id, stock_ticker, shares, price_per_share) VALUES (?, ?, ?, ?, ?, ?)",
+         p2p_rows()),
+    ]
+
+    initialize_database(database)
+    conn = connect(database)
+    try:
+        # Nothing to lose if generation fails halfway, so skip the journal and syncing to disk while loading
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        placeholders = ", ".join("?" * len(BULK_TABLES))
+        indexes = conn.execute(
+            f"SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ({placeholders})", BULK_TABLES
+        ).fetchall()
+        for name, _ in indexes:
+            conn.execute(f"DROP INDEX {name}")
+
+        counts = {}
+        for table, query, rows in tables:
+            started = time.perf_counter()
+            counts[table] = 0
+            while batch := list(islice(rows, batch_size)):
+                with conn:
+                    conn.executemany(query, batch)
+                counts[table] += len(batch)
+                log(f"{table}: {counts[table]:,} rows ({counts[table] / (time.perf_counter() - started):,.0f} rows/s)")
+
+        started = time.perf_counter()
+        with conn:
+            for _, sql in indexes:
+                conn.execute(sql)
+
+            # Summaries the app would have kept up to date with every trade
+            conn.execute("""
+                INSERT OR REPLACE INTO portfolio_summary (user_id, cost_basis, shares)
+                SELECT user_id, SUM(avg_price * (amount + frozen_amount)), SUM(amount + frozen_amount)
+                FROM stock_ownership
+                GROUP BY user_id
+            """)
+        log(f"indexes: {len(indexes)} built in {time.perf_counter() - started:.1f}s")
+        conn.execute("PRAGMA journal_mode = WAL")
+    finally:
+        conn.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic MockStocks database for scale testing.")
+    parser.add_argument("database", help="path of the new database file")
+    parser.add_argument("--users", type=int, default=1000, help="number of users (default: 1000)")
+    parser.add_argument("--holdings", type=int, default=10, help="average number of stocks each user holds (default: 10)")
+    parser.add_argument("--market-transactions", type=int, default=100_000, help="rows of market trade history (default: 100000)")
+    parser.add_argument("--p2p-transactions", type=int, default=25_000, help="rows of P2P trade history (default: 25000)")
+    parser.add_argument("--proposals", type=int, default=2000, help="open P2P proposals (default: 2000)")
+    parser.add_argument("--days", type=int, default=365, help="days of trade history (default: 365)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed, the same seed generates the same data (default: 0)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help=f"rows per insert transaction (default: {BATCH_SIZE})")
+    parser.add_argument("--force", action="store_true", help="replace database if it already exists")
+    args = parser.parse_args()
+    if args.users < 2 or args.holdings < 1 or args.days < 7:
+        parser.error("at least 2 users, 1 holding and 7 days are needed")
+
+    if args.force:
+        for path in (args.database, args.database + "-wal", args.database + "-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    started = time.perf_counter()
+    try:
+        counts = generate(
+            args.database, users=args.users, holdings=args.holdings, market_transactions=args.market_transactions,
+            p2p_transactions=args.p2p_transactions, proposals=args.proposals, days=args.days, seed=args.seed,
+            batch_size=args.batch_size, verbose=True
+        )
+    except FileExistsError as e:
+        parser.error(f"{e}, use --force to replace it")
+    print(f"Generated {sum(counts.values()):,} rows in {args.database} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+import multiprocessing
+import os
+
+# Multi-process deployment: gunicorn -c gunicorn.conf.py app:app
+# Sessions live in the database already, rate limit counters are shared through the same database file
+# unless RATELIMIT_STORAGE_URI points somewhere else (e.g. redis://localhost:6379)
+os.environ.setdefault("RATELIMIT_STORAGE_URI", f"sqlite:///{os.environ.get('DATABASE', 'mockstocks.db')}")
+
+# Threaded workers would give up a thread to every open price stream for as long as a page stays open,
+# so pages poll for prices instead
+os.environ.setdefault("PRICE_STREAMING", "0")
+
+# With PRICE_REFRESHER=1 every worker starts a refresher thread after it is forked, and a lease in the database
+# picks the one that refreshes prices. The master runs no threads of its own, so forking it is safe.
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+# One worker per core by default, each serving requests on a few threads
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+
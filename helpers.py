@@ -1,7 +1,33 @@
-import plotly.graph_objects as go
-import yfinance as yf
+import datetime
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 from flask import redirect, render_template, session
 from functools import wraps
+import repository
+from database import TransactionError, execute_transaction
+from metrics import timed
+from providers import get_provider, period_start
+
+# Quote cache configuration (seconds to keep a quote, max number of symbols kept)
+QUOTE_CACHE_TTL = float(os.environ.get("QUOTE_CACHE_TTL", 15))
+QUOTE_CACHE_SIZE = int(os.environ.get("QUOTE_CACHE_SIZE", 512))
+# Seconds to answer a symbol from a failed fetch before calling upstream again
+QUOTE_FAILURE_TTL = float(os.environ.get("QUOTE_FAILURE_TTL", 5))
+# Batch quote fetching (worker threads, symbols per upstream request, overall deadline in seconds)
+QUOTE_WORKERS = int(os.environ.get("QUOTE_WORKERS", 8))
+QUOTE_BATCH_SIZE = int(os.environ.get("QUOTE_BATCH_SIZE", 10))
+QUOTE_DEADLINE = float(os.environ.get("QUOTE_DEADLINE", 2.0))
+# Local price table kept fresh by the background refresher (see refresher.py)
+PRICE_REFRESHER = os.environ.get("PRICE_REFRESHER", "0") == "1"
+PRICE_MAX_AGE = float(os.environ.get("PRICE_MAX_AGE", 30))
+# Seconds between incremental price history fetches for the same symbol
+HISTORY_SYNC_INTERVAL = float(os.environ.get("HISTORY_SYNC_INTERVAL", 300))
+# Rendered chart payloads (seconds to keep one, max number kept)
+CHART_CACHE_TTL = float(os.environ.get("CHART_CACHE_TTL", 3600))
+CHART_CACHE_SIZE = int(os.environ.get("CHART_CACHE_SIZE", 128))
 
 # Apology/error message
 def apology(message, code=400):
@@ -42,35 +68,368 @@ def login_required(f):
     return decorated_function
 
 
+class _Flight:
+    """Fetch in progress for one key, whose result is handed to every thread waiting on it."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+# Process-wide quote cache
+class QuoteCache:
+    """
+    Thread-safe TTL cache with LRU eviction and single-flight fetching.
+    Concurrent misses for the same key wait on one fetch and all get its result, even when it failed.
+    Failed fetches (None or an exception) are remembered for failure_ttl seconds, during which the key returns None.
+    """
+
+    def __init__(self, ttl=QUOTE_CACHE_TTL, maxsize=QUOTE_CACHE_SIZE, failure_ttl=QUOTE_FAILURE_TTL):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.failure_ttl = failure_ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value, stored_at wall-clock time)
+        self._failures = OrderedDict()  # key -> expires_at of the last failed fetch
+        self._inflight = {}  # key -> _Flight
+        self._lock = threading.Lock()
+
+    def get(self, key, fetch):
+        """Return cached value for key, calling fetch() once on a miss."""
+        with self._lock:
+            now = time.monotonic()
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                return entry[1]
+            if self._failures.get(key, 0) > now:
+                return None
+
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                # This thread becomes the leader and performs the fetch
+                flight = self._inflight[key] = _Flight()
+
+        if not leader:
+            # Another thread is already fetching this key, share its result
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = fetch()
+        except Exception as e:
+            flight.error = e
+            self._fail(key)
+            raise
+        else:
+            if flight.value is None:
+                self._fail(key)
+            else:
+                self.set(key, flight.value)
+            return flight.value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+
+    def get_many(self, keys, fetch_many):
+        """
+        Return a dictionary of key -> value for keys, calling fetch_many(missing keys) once for the keys no other thread
+        is fetching. Keys already being fetched, alone or in another batch, wait for that fetch instead.
+        Keys whose fetch failed are left out.
+        """
+        values = {}
+        leading = {}
+        waiting = {}
+        with self._lock:
+            now = time.monotonic()
+            for key in dict.fromkeys(keys):
+                entry = self._entries.get(key)
+                if entry and entry[0] > now:
+                    self._entries.move_to_end(key)
+                    values[key] = entry[1]
+                elif self._failures.get(key, 0) > now:
+                    continue
+                elif key in self._inflight:
+                    waiting[key] = self._inflight[key]
+                else:
+                    leading[key] = self._inflight[key] = _Flight()
+
+        if leading:
+            try:
+                fetched = fetch_many(list(leading))
+            except Exception as e:
+                for key, flight in leading.items():
+                    flight.error = e
+                    self._fail(key)
+                raise
+            else:
+                for key, flight in leading.items():
+                    flight.value = fetched.get(key)
+                    if flight.value is None:
+                        self._fail(key)
+                    else:
+                        self.set(key, flight.value)
+                        values[key] = flight.value
+            finally:
+                with self._lock:
+                    for key in leading:
+                        self._inflight.pop(key, None)
+                for flight in leading.values():
+                    flight.done.set()
+
+        # Only wait for other fetches after finishing our own, so two batches never wait on each other
+        for key, flight in waiting.items():
+            flight.done.wait()
+            if flight.value is not None:
+                values[key] = flight.value
+        return values
+
+    def _fail(self, key):
+        """Remember that fetching key just failed."""
+        with self._lock:
+            self._failures[key] = time.monotonic() + self.failure_ttl
+            self._failures.move_to_end(key)
+            while len(self._failures) > self.maxsize:
+                self._failures.popitem(last=False)
+
+    def peek(self, key):
+        """Return cached value for key if it is still fresh, without fetching."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                return entry[1]
+        return None
+
+    def last_known(self, key):
+        """Return last value stored for key even if it has expired, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[1] if entry else None
+
+    def stored_at(self, key):
+        """Return wall-clock time when key was last stored, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[2] if entry else None
+
+    def set(self, key, value):
+        """Store value for key and evict least recently used entries over maxsize."""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value, time.time())
+            self._entries.move_to_end(key)
+            self._failures.pop(key, None)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._failures.clear()
+
+
+quote_cache = QuoteCache()
+# Prices fetched in bulk have no company name, so they are kept apart from full quotes
+price_cache = QuoteCache()
+# Bounded pool for upstream price fetches, shared by all requests
+quote_executor = ThreadPoolExecutor(max_workers=QUOTE_WORKERS, thread_name_prefix="quote")
+# Symbols whose stored price history was synced recently (single-flight, so one fetch per symbol at a time)
+history_sync = QuoteCache(ttl=HISTORY_SYNC_INTERVAL)
+# Rendered chart JSON per (symbol, period, day)
+chart_cache = QuoteCache(ttl=CHART_CACHE_TTL, maxsize=CHART_CACHE_SIZE)
+# Last time (epoch seconds) each symbol was requested by a user in this process, until the refresher of this process
+# stores it in the price_demand table, where the refresher of whichever process refreshes prices finds hot symbols
+demand = {}
+
+
 # Stock quote lookup
+@timed("quotes")
 def lookup(symbol):
-    """Look up stock quote for a given symbol using Yahoo Finance."""
-    try:
-        stock = yf.Ticker(symbol)
-        info = stock.info
-
-        return {
-            "name": info.get("longName", "Unknown"),
-            "price": info.get("currentPrice"),
-            "symbol": symbol.upper()
-        }
-    except Exception as e:
-        print(f"Yahoo Finance API error: {e}")
+    """Look up stock quote for a given symbol, served from the quote cache or local price table when fresh."""
+    symbol = symbol.upper()
+    if PRICE_REFRESHER:
+        demand[symbol] = time.time()
+    return quote_cache.get(symbol, lambda: _local_quote(symbol) or _fetch_quote(symbol))
+
+
+def _local_quote(symbol):
+    """Return quote for symbol from the local price table if it's recent enough."""
+    if not PRICE_REFRESHER:
         return None
 
+    row = repository.get_local_quote(symbol, time.time() - PRICE_MAX_AGE)
+    if not row:
+        return None
+    return {"name": row[0], "price": row[1], "symbol": symbol}
+
+
+def _local_prices(symbols):
+    """Return recent prices for several symbols from the local price table."""
+    if not PRICE_REFRESHER:
+        return {}
+
+    return repository.get_local_prices(symbols, time.time() - PRICE_MAX_AGE)
+
+
+def _fetch_quote(symbol):
+    """Fetch stock quote for a given symbol from the configured quote provider."""
+    return get_provider().get_quote(symbol)
+
+
+# Batch stock price lookup
+@timed("quotes")
+def lookup_many(symbols, deadline=QUOTE_DEADLINE):
+    """
+    Look up current prices for several symbols at once.
+    Fresh cached or locally refreshed prices are reused and the remaining symbols are fetched in parallel batches.
+    Symbols not fetched within the deadline fall back to their last known price and are reported as stale.
+    Returns (prices, stale): a dictionary of symbol -> price and a set of symbols with stale prices.
+    Symbols that have never been priced are left out of both.
+    """
+    prices = {}
+    missing = []
+    now = time.time()
+    for symbol in dict.fromkeys(symbol.upper() for symbol in symbols):
+        if PRICE_REFRESHER:
+            demand[symbol] = now
+        price = _cached_price(symbol, fresh=True)
+        if price is not None:
+            prices[symbol] = price
+        else:
+            missing.append(symbol)
+
+    if missing:
+        local = _local_prices(missing)
+        for symbol, price in local.items():
+            price_cache.set(symbol, price)
+        prices.update(local)
+        missing = [symbol for symbol in missing if symbol not in local]
+
+    stale = set()
+    if missing:
+        batches = [missing[i:i + QUOTE_BATCH_SIZE] for i in range(0, len(missing), QUOTE_BATCH_SIZE)]
+        futures = [quote_executor.submit(_refresh_prices, batch) for batch in batches]
+        # Late batches keep running in the background and still fill the cache for the next request
+        wait(futures, timeout=deadline)
+
+        for future in futures:
+            if future.done() and not future.exception():
+                prices.update(future.result())
+
+        for symbol in missing:
+            if symbol not in prices:
+                price = _cached_price(symbol, fresh=False)
+                if price is not None:
+                    prices[symbol] = price
+                    stale.add(symbol)
+
+    return prices, stale
+
+
+def _cached_price(symbol, fresh):
+    """Return a cached price for symbol from either cache, optionally accepting expired entries."""
+    if fresh:
+        quote, price = quote_cache.peek(symbol), price_cache.peek(symbol)
+    else:
+        quote, price = quote_cache.last_known(symbol), price_cache.last_known(symbol)
+
+    if quote and quote["price"] is not None:
+        return quote["price"]
+    return price
+
+
+def quotes_updated_at(symbols):
+    """Return the most recent time any of symbols' cached quotes or prices were stored, or None."""
+    times = [
+        stored for symbol in symbols
+        for stored in (quote_cache.stored_at(symbol.upper()), price_cache.stored_at(symbol.upper()))
+        if stored is not None
+    ]
+    return max(times, default=None)
+
+
+def _refresh_prices(symbols):
+    """Fetch prices for a batch of symbols through the price cache, sharing fetches already in flight for any of them."""
+    return price_cache.get_many(symbols, _fetch_prices)
+
+
+def _fetch_prices(symbols):
+    """Fetch latest prices for several symbols from the configured quote provider."""
+    return get_provider().get_prices(symbols)
+
 
 # Format USD
 def usd(value):
     """Format value as USD."""
     return f"${value:,.2f}"
 
-# Make stock chart using Plotly and Yahoo Finance
-def get_stock_chart(symbol):
-    stock = yf.Ticker(symbol)
-    hist = stock.history(period="3mo")
+# Price history backed by the local price_history table
+def get_price_history(symbol, period="3mo"):
+    """
+    Return daily bars for symbol covering period from the local store.
+    The store is filled incrementally: only bars after the last stored one are fetched.
+    """
+    symbol = symbol.upper()
+    history_sync.get((symbol, period), lambda: _sync_price_history(symbol, period))
+
+    _, last = repository.get_history_range(symbol)
+    if last is None:
+        return []
+    # The period ends at the last stored bar, which is today for live quotes but may be older for recorded ones
+    return repository.list_price_history(symbol, period_start(period, datetime.date.fromisoformat(last)).isoformat())
+
+
+def _sync_price_history(symbol, period):
+    """Fetch bars missing from the local store for symbol over period. Returns None if they couldn't be fetched or stored."""
+    first, last = repository.get_history_range(symbol)
+
+    # Charts can still be drawn from the bars stored so far, and the sync is tried again shortly
+    try:
+        # Allow a week of slack since the period may start on a weekend or holiday
+        if first is None or first > (period_start(period, datetime.date.fromisoformat(last)) + datetime.timedelta(days=7)).isoformat():
+            # The provider knows which dates period covers
+            bars = get_provider().get_history(symbol, period=period)
+        else:
+            # Re-fetch the last stored bar too, it may have been stored mid-day
+            bars = get_provider().get_history(symbol, start=last)
+    except Exception as e:
+        print(f"Price history error: {e}")
+        return None
+
+    if bars:
+        try:
+            execute_transaction([repository.upsert_price_bar(symbol, bar) for bar in bars])
+        except TransactionError as e:
+            print(f"Price history error: {e}")
+            return None
+    return True
+
+
+# Make stock chart using Plotly and the locally stored price history
+@timed("chart")
+def get_stock_chart(symbol, period="3mo"):
+    """
+    Return Plotly figure JSON for symbol's price chart, or None if there is no history.
+    Payloads are cached per day, so the figure is only built once per symbol and period.
+    """
+    symbol = symbol.upper()
+    return chart_cache.get((symbol, period, datetime.date.today()), lambda: _build_stock_chart(symbol, period))
+
+
+def _build_stock_chart(symbol, period):
+    hist = get_price_history(symbol, period=period)
+    if not hist:
+        return None
+
+    # plotly is only needed for charts, so it isn't imported at startup
+    import plotly.graph_objects as go
 
     fig = go.Figure()
-    fig.add_trace(go.Scatter(x=hist.index, y=hist['Close'], mode='lines', name='Close Price'))
+    fig.add_trace(go.Scatter(x=[bar["date"] for bar in hist], y=[bar["close"] for bar in hist], mode='lines', name='Close Price'))
 
     fig.update_layout(
         title=f"{symbol} Stock Price",
@@ -79,5 +438,4 @@ def get_stock_chart(symbol):
         template="plotly_dark"
     )
 
-    return fig.to_html(full_html=False)
-  
\ No newline at end of file
+    return fig.to_json()
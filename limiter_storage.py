@@ -0,0 +1,79 @@
+import sqlite3
+import time
+from limits.storage import Storage
+from database import DATABASE, connect
+
+# Seconds between removals of expired rate limit counters
+PURGE_INTERVAL = 300
+
+
+class SQLiteStorage(Storage):
+    """
+    Rate limit counters in a SQLite table, shared by every process using the same database file.
+    Importing this module registers the sqlite:/// scheme, e.g. RATELIMIT_STORAGE_URI=sqlite:///mockstocks.db
+    Supports the fixed window strategies Flask-Limiter uses by default.
+    """
+
+    STORAGE_SCHEME = ["sqlite"]
+
+    def __init__(self, uri=None, wrap_exceptions=False, **options):
+        # sqlite:///relative/path.db or sqlite:////absolute/path.db
+        path = uri.split("://", 1)[1] if uri else ""
+        self.conn = connect(path[1:] if path.startswith("/") else path or DATABASE)
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS rate_limits (
+                    key TEXT PRIMARY KEY NOT NULL,
+                    count INTEGER NOT NULL,
+                    expires_at REAL NOT NULL
+                ) WITHOUT ROWID
+            """)
+        self.purged_at = 0
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def incr(self, key, expiry, elastic_expiry=False, amount=1):
+        """Increment counter for key in one statement, starting a new window if the previous one expired."""
+        now = time.time()
+        with self.lock, self.conn:
+            if now - self.purged_at > PURGE_INTERVAL:
+                self.conn.execute("DELETE FROM rate_limits WHERE expires_at <= ?", (now,))
+                self.purged_at = now
+
+            return self.conn.execute(
+                """INSERT INTO rate_limits (key, count, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    count = CASE WHEN rate_limits.expires_at <= ? THEN excluded.count ELSE rate_limits.count + excluded.count END,
+                    expires_at = CASE WHEN rate_limits.expires_at <= ? OR ? THEN excluded.expires_at ELSE rate_limits.expires_at END
+                RETURNING count""",
+                (key, amount, now + expiry, now, now, elastic_expiry)
+            ).fetchone()[0]
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT count FROM rate_limits WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT expires_at FROM rate_limits WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else time.time()
+
+    def check(self):
+        try:
+            with self.lock:
+                self.conn.execute("SELECT 1")
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        with self.lock, self.conn:
+            return self.conn.execute("DELETE FROM rate_limits").rowcount
+
+    def clear(self, key):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM rate_limits WHERE key = ?", (key,))
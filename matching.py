@@ -0,0 +1,201 @@
+import heapq
+import threading
+from contextlib import contextmanager
+from dataclasses import replace
+import repository
+from database import TransactionError
+
+# Guard message for resting proposals that changed after they were matched
+MATCH_CONFLICT = "A matched trade is no longer available, please try again"
+
+
+class MatchConflict(TransactionError):
+    """Raised when a resting proposal matched from a book was changed elsewhere before the trade was stored."""
+
+
+class OrderBook:
+    """
+    Resting P2P proposals of one ticker in price-time priority.
+    Bids (BUYING) are kept in a max-heap and asks (SELLING) in a min-heap keyed on (price, time posted, p2p_id).
+    Removed or repriced proposals are deleted lazily: their heap entries are skipped once they no longer
+    match the proposal stored in orders, and the heaps are rebuilt from orders once stale entries outnumber
+    live ones twice over.
+    """
+
+    def __init__(self, ticker):
+        self.ticker = ticker
+        self.orders = {}  # p2p_id -> Proposal
+        self.bids = []
+        self.asks = []
+        self.last_id = 0  # highest p2p_id loaded from database
+        self.lock = threading.Lock()
+
+    def sync(self):
+        """Load proposals posted since the last sync, including any posted by other processes."""
+        for proposal in repository.list_ticker_proposals(self.ticker, self.last_id):
+            self.add(proposal)
+            self.last_id = max(self.last_id, proposal.p2p_id)
+
+    def add(self, proposal):
+        """Add proposal to the book, or replace it if it is already there."""
+        previous = self.orders.get(proposal.p2p_id)
+        self.orders[proposal.p2p_id] = proposal
+        # Edits that keep the price leave the heap entry valid, as its key doesn't include the amount
+        if previous is None or previous.type != proposal.type or self._key(previous) != self._key(proposal):
+            heapq.heappush(self.bids if proposal.type == "BUYING" else self.asks, self._key(proposal))
+            self._compact()
+
+    def discard(self, p2p_id):
+        if self.orders.pop(p2p_id, None):
+            self._compact()
+
+    def match(self, taker):
+        """
+        Return fills for taker, a proposal that hasn't been added to the book, as a list of (resting proposal, shares).
+        Crossing proposals are taken best price first, oldest first at the same price, and always trade at the
+        resting proposal's price. Proposals of the same user are never matched. The book itself isn't changed,
+        call fill once the trades are stored.
+        """
+        heap = self.asks if taker.type == "BUYING" else self.bids
+        remaining = taker.amount
+        fills = []
+        popped = []
+        seen = set()
+        while heap and remaining > 0:
+            key = heap[0]
+            resting = self.orders.get(key[-1])
+            if resting is None or self._key(resting) != key or resting.p2p_id in seen:
+                # Stale entry of a removed or repriced proposal, or a duplicate of one repriced back and forth
+                heapq.heappop(heap)
+                continue
+            seen.add(resting.p2p_id)
+            if (resting.price > taker.price) if taker.type == "BUYING" else (resting.price < taker.price):
+                break
+
+            popped.append(heapq.heappop(heap))
+            if resting.user_id == taker.user_id:
+                continue
+            shares = min(remaining, resting.amount)
+            fills.append((resting, shares))
+            remaining -= shares
+
+        for key in popped:
+            heapq.heappush(heap, key)
+        return fills
+
+    def fill(self, fills):
+        """Take filled shares off resting proposals, removing the ones filled completely."""
+        for resting, shares in fills:
+            if resting.amount - shares > 0:
+                self.orders[resting.p2p_id] = replace(resting, amount=resting.amount - shares)
+            else:
+                self.orders.pop(resting.p2p_id, None)
+        self._compact()
+
+    def _compact(self):
+        """Rebuild the heaps from orders once more than two thirds of their entries are stale."""
+        if len(self.bids) + len(self.asks) <= 3 * len(self.orders):
+            return
+        self.bids = [self._key(proposal) for proposal in self.orders.values() if proposal.type == "BUYING"]
+        self.asks = [self._key(proposal) for proposal in self.orders.values() if proposal.type == "SELLING"]
+        heapq.heapify(self.bids)
+        heapq.heapify(self.asks)
+
+    @staticmethod
+    def _key(proposal):
+        price = -proposal.price if proposal.type == "BUYING" else proposal.price
+        return (price, proposal.time_posted, proposal.p2p_id)
+
+
+class MatchingEngine:
+    """Order books of every ticker traded since startup, loaded from database on first use."""
+
+    def __init__(self):
+        self.books = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def book(self, ticker):
+        """
+        Lock and return the up to date book for ticker.
+        The lock is held while the caller stores its trades, so fills computed from the book can't be
+        taken by another request of this process in the meantime. If a trade fails because a resting
+        proposal was changed elsewhere, the book is dropped and reloaded on next use.
+        """
+        with self.lock:
+            book = self.books.get(ticker)
+            if book is None:
+                book = self.books[ticker] = OrderBook(ticker)
+
+        with book.lock:
+            try:
+                book.sync()
+                yield book
+            except MatchConflict:
+                with self.lock:
+                    self.books.pop(ticker, None)
+                raise
+
+    def discard(self, ticker, p2p_id):
+        """Forget a proposal that was accepted or removed outside the engine."""
+        with self.lock:
+            book = self.books.get(ticker)
+        if book:
+            with book.lock:
+                book.discard(p2p_id)
+
+
+def unfilled(taker, fills):
+    """Shares of taker left after fills."""
+    remaining = taker.amount
+    for _, shares in fills:
+        remaining -= shares
+    return remaining
+
+
+def fill_statements(taker, fills):
+    """
+    Statements storing fills of taker, all of which trade at the resting proposal's price.
+    If taker.p2p_id is set the taker is a resting proposal itself, paid from its frozen cash or shares,
+    otherwise it is paid from the user's available cash or shares.
+    """
+    if not fills:
+        return []
+
+    statements = []
+    for resting, shares in fills:
+        buyer, seller = (taker, resting) if taker.type == "BUYING" else (resting, taker)
+        total = resting.price * shares
+
+        # Take the shares off the matched proposal, only if nobody else accepted or edited it in the meantime
+        statements += [repository.fill_proposal(resting, shares, MatchConflict(MATCH_CONFLICT)), repository.delete_filled_proposal(resting.p2p_id)]
+        if taker.p2p_id is not None:
+            statements += [repository.fill_proposal(taker, shares, "This trade is no longer available"), repository.delete_filled_proposal(taker.p2p_id)]
+
+        # Buyer pays the trade price, a resting buyer gets back whatever it froze above that price
+        if buyer.p2p_id is None:
+            statements.append(repository.debit_cash(buyer.user_id, total, "You don't have enough cash to buy these stocks"))
+        else:
+            statements.append(repository.release_frozen_cash(buyer.user_id, buyer.price * shares))
+            if buyer.price > resting.price:
+                statements.append(repository.credit_cash(buyer.user_id, (buyer.price - resting.price) * shares))
+        statements.append(repository.add_shares(buyer.user_id, taker.stock_ticker, shares, resting.price))
+
+        # Seller hands over the shares and receives the cash
+        if seller.p2p_id is None:
+            statements.append(repository.remove_shares(seller.user_id, taker.stock_ticker, shares, "You don't have enough stocks to sell"))
+        else:
+            statements.append(repository.release_frozen_shares(seller.user_id, taker.stock_ticker, shares))
+        statements += [
+            repository.delete_empty_holding(seller.user_id, taker.stock_ticker),
+            repository.credit_cash(seller.user_id, total),
+            repository.insert_p2p_transaction(buyer.user_id, seller.user_id, taker.stock_ticker, shares, resting.price),
+        ]
+
+    # Update portfolio summaries of everyone involved
+    for user_id in dict.fromkeys([taker.user_id] + [resting.user_id for resting, _ in fills]):
+        statements.append(repository.refresh_portfolio_summary(user_id))
+    return statements
+
+
+engine = MatchingEngine()
@@ -0,0 +1,113 @@
+import os
+import threading
+import time
+from functools import wraps
+from flask import g, has_app_context
+
+# Set to 0 to leave the Server-Timing header out of responses
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "1") == "1"
+# Bearer token required to read /metrics, open to anyone if empty
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+# Upper bounds of histogram buckets in seconds, as in the Prometheus client libraries
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """Prometheus-style histogram of observations per set of label values, safe to share between threads."""
+
+    def __init__(self, name, help, labels, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # label values -> [count per bucket, sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def expose(self):
+        """Return the histogram in the Prometheus text exposition format."""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = sorted((label_values, [list(buckets), total, count]) for label_values, (buckets, total, count) in self.series.items())
+        for label_values, (buckets, total, count) in series:
+            labels = ",".join(f'{label}="{_escape(value)}"' for label, value in zip(self.labels, label_values))
+            for bound, bucket_count in zip(self.buckets, buckets):
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {bucket_count}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return "\n".join(lines)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+request_duration = Histogram("mockstocks_request_duration_seconds", "Time spent handling requests until the response was returned.", ("endpoint",))
+phase_duration = Histogram("mockstocks_request_phase_seconds", "Time spent per request in database queries, quote lookups, charts and templates.", ("endpoint", "phase"))
+phase_calls = Histogram("mockstocks_request_phase_calls", "Calls per request to database queries, quote lookups, charts and templates.", ("endpoint", "phase"),
+                        buckets=(1, 2, 5, 10, 20, 50, 100))
+
+
+def timed(phase):
+    """
+    Add the time spent in the decorated function to phase of the current request.
+    Calls outside of a request (or app context of a background thread) aren't recorded. A phase called from
+    another one, like database queries made by quote lookups, counts towards both.
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                if has_app_context():
+                    timing = g.setdefault("timings", {}).setdefault(phase, [0.0, 0])
+                    timing[0] += time.perf_counter() - start
+                    timing[1] += 1
+        return wrapper
+
+    return decorator
+
+
+def start_request():
+    """Remember when the current request started."""
+    g.request_started = time.perf_counter()
+
+
+def finish_request(response, endpoint):
+    """Record timings of the current request in the histograms and add them to response as a Server-Timing header."""
+    started = g.pop("request_started", None)
+    if started is None:
+        return response
+    total = time.perf_counter() - started
+    timings = g.pop("timings", {})
+
+    endpoint = endpoint or "none"
+    request_duration.observe(total, endpoint)
+    for phase, (seconds, calls) in timings.items():
+        phase_duration.observe(seconds, endpoint, phase)
+        phase_calls.observe(calls, endpoint, phase)
+
+    if SERVER_TIMING:
+        entries = [f'{phase};dur={seconds * 1000:.1f};desc="{calls} call{"s" if calls != 1 else ""}"' for phase, (seconds, calls) in timings.items()]
+        response.headers["Server-Timing"] = ", ".join(entries + [f"total;dur={total * 1000:.1f}"])
+    return response
+
+
+def expose():
+    """Return all histograms in the Prometheus text exposition format."""
+    return "\n".join(histogram.expose() for histogram in (request_duration, phase_duration, phase_calls)) + "\n"
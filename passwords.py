@@ -0,0 +1,57 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Processes hashing passwords (0 hashes on the request thread instead)
+PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", os.cpu_count() or 1))
+# Maximum number of hashes queued or running at once before new logins are turned away
+PASSWORD_QUEUE_LIMIT = int(os.environ.get("PASSWORD_QUEUE_LIMIT", 64))
+
+
+class PasswordPoolBusy(Exception):
+    """Raised when too many password hashes are already waiting."""
+
+
+class PasswordHasher:
+    """
+    Bounded process pool for password hashing, which is deliberately slow and would otherwise hold the GIL
+    on request threads. The pool is started on first use in each process, so forked server workers get their own.
+    """
+
+    def __init__(self, workers=PASSWORD_WORKERS, queue_limit=PASSWORD_QUEUE_LIMIT):
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(queue_limit)
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pid = None
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password)
+
+    def verify(self, passhash, password):
+        return self.run(check_password_hash, passhash, password)
+
+    def run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+
+        if not self.slots.acquire(blocking=False):
+            raise PasswordPoolBusy("Too many login attempts right now, please try again")
+        try:
+            return self.pool().submit(fn, *args).result()
+        finally:
+            self.slots.release()
+
+    def pool(self):
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                # Fork where available, so workers don't re-run the application module on start
+                context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+                self.pid = os.getpid()
+            return self.executor
+
+
+hasher = PasswordHasher()
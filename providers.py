@@ -0,0 +1,210 @@
+import datetime
+import json
+import math
+import os
+import random
+import time
+import zlib
+from functools import lru_cache
+
+# Quote provider selection ("yahoo", "synthetic" or "replay")
+QUOTE_PROVIDER = os.environ.get("QUOTE_PROVIDER", "yahoo")
+# Artificial latency in seconds added to every offline provider call
+QUOTE_PROVIDER_LATENCY = float(os.environ.get("QUOTE_PROVIDER_LATENCY", 0))
+# JSON file with recorded quotes and history used by the replay provider
+QUOTE_REPLAY_FILE = os.environ.get("QUOTE_REPLAY_FILE", "quotes_replay.json")
+
+
+def period_start(period, today=None):
+    """Convert a period string like "5d", "3mo" or "1y" into a start date."""
+    today = today or datetime.date.today()
+    for suffix, days in (("mo", 31), ("d", 1), ("y", 366)):
+        if period.endswith(suffix):
+            return today - datetime.timedelta(days=int(period[:-len(suffix)]) * days)
+    raise ValueError(f"Unsupported period: {period}")
+
+
+class QuoteProvider:
+    """
+    Source of stock quotes and price history.
+    Quotes are dictionaries with name, price and symbol keys, history is a list of daily bars
+    (dictionaries with date, open, high, low, close and volume keys) sorted by date.
+    """
+
+    def get_quote(self, symbol):
+        """Return quote for symbol, or None if it couldn't be fetched."""
+        raise NotImplementedError
+
+    def get_prices(self, symbols):
+        """Return a dictionary of symbol -> latest price, leaving out symbols without a price."""
+        prices = {}
+        for symbol in symbols:
+            quote = self.get_quote(symbol)
+            if quote and quote["price"] is not None:
+                prices[symbol] = quote["price"]
+        return prices
+
+    def get_history(self, symbol, period="3mo", start=None):
+        """Return daily bars for symbol covering period, or from start date (YYYY-MM-DD) onwards if given."""
+        raise NotImplementedError
+
+
+class YahooProvider(QuoteProvider):
+    """
+    Live quotes and history from Yahoo Finance.
+    yfinance pulls in pandas and numpy, so it is only imported once the first quote is requested.
+    """
+
+    def get_quote(self, symbol):
+        import yfinance as yf
+        try:
+            stock = yf.Ticker(symbol)
+            info = stock.info
+
+            return {
+                "name": info.get("longName", "Unknown"),
+                "price": info.get("currentPrice"),
+                "symbol": symbol.upper()
+            }
+        except Exception as e:
+            print(f"Yahoo Finance API error: {e}")
+            return None
+
+    def get_prices(self, symbols):
+        """Fetch latest prices for several symbols in a single download."""
+        import yfinance as yf
+        try:
+            closes = yf.download(symbols, period="5d", progress=False, auto_adjust=False, threads=False)["Close"]
+            if not hasattr(closes, "columns"):
+                closes = closes.to_frame(name=symbols[0])
+
+            prices = {}
+            for symbol in symbols:
+                if symbol in closes.columns:
+                    series = closes[symbol].dropna()
+                    if not series.empty:
+                        prices[symbol] = float(series.iloc[-1])
+            return prices
+        except Exception as e:
+            print(f"Yahoo Finance API error: {e}")
+            return {}
+
+    def get_history(self, symbol, period="3mo", start=None):
+        import yfinance as yf
+        stock = yf.Ticker(symbol)
+        hist = stock.history(start=start) if start else stock.history(period=period)
+        return [
+            {
+                "date": index.date().isoformat(),
+                "open": float(row["Open"]),
+                "high": float(row["High"]),
+                "low": float(row["Low"]),
+                "close": float(row["Close"]),
+                "volume": int(row["Volume"]),
+            }
+            for index, row in hist.iterrows()
+        ]
+
+
+class SyntheticProvider(QuoteProvider):
+    """
+    Deterministic offline prices following a geometric Brownian motion per symbol.
+    The same symbol always produces the same path, so benchmarks and tests are repeatable.
+    """
+
+    # Every path starts on this date so that any history window is a slice of the same path
+    EPOCH = datetime.date(2020, 1, 1)
+
+    def __init__(self, latency=QUOTE_PROVIDER_LATENCY, drift=0.0003, volatility=0.02):
+        self.latency = latency
+        self.drift = drift
+        self.volatility = volatility
+
+    def get_quote(self, symbol):
+        self._sleep()
+        symbol = symbol.upper()
+        return {"name": f"{symbol} Synthetic Inc.", "price": self._path(symbol, datetime.date.today())[-1]["close"], "symbol": symbol}
+
+    def get_prices(self, symbols):
+        self._sleep()
+        today = datetime.date.today()
+        return {symbol: self._path(symbol.upper(), today)[-1]["close"] for symbol in symbols}
+
+    def get_history(self, symbol, period="3mo", start=None):
+        self._sleep()
+        today = datetime.date.today()
+        start = start or period_start(period, today).isoformat()
+        return [bar for bar in self._path(symbol.upper(), today) if bar["date"] >= start]
+
+    def _sleep(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    @lru_cache(maxsize=256)
+    def _path(self, symbol, today):
+        """Generate daily bars for symbol from EPOCH up to today, skipping weekends."""
+        rng = random.Random(zlib.crc32(symbol.encode()))
+        price = rng.uniform(20, 500)
+        bars = []
+        day = self.EPOCH
+        while day <= today:
+            if day.weekday() < 5:
+                open_price = price
+                price *= math.exp(self.drift - self.volatility ** 2 / 2 + self.volatility * rng.gauss(0, 1))
+                spread = abs(rng.gauss(0, self.volatility / 2))
+                bars.append({
+                    "date": day.isoformat(),
+                    "open": round(open_price, 2),
+                    "high": round(max(open_price, price) * (1 + spread), 2),
+                    "low": round(min(open_price, price) * (1 - spread), 2),
+                    "close": round(price, 2),
+                    "volume": rng.randint(100_000, 10_000_000),
+                })
+            day += datetime.timedelta(days=1)
+        return bars
+
+
+class ReplayProvider(QuoteProvider):
+    """
+    Offline quotes and history replayed from a recorded JSON file, shaped like:
+    {"AAPL": {"name": "Apple Inc.", "price": 227.5, "history": [{"date": "2025-01-02", "close": 243.85, ...}]}}
+    Symbols missing from the file are reported as unknown, the same way Yahoo Finance does.
+    """
+
+    def __init__(self, path=QUOTE_REPLAY_FILE, latency=QUOTE_PROVIDER_LATENCY):
+        self.latency = latency
+        with open(path) as f:
+            self.data = {symbol.upper(): record for symbol, record in json.load(f).items()}
+
+    def get_quote(self, symbol):
+        if self.latency:
+            time.sleep(self.latency)
+        symbol = symbol.upper()
+        record = self.data.get(symbol, {})
+        return {"name": record.get("name", "Unknown"), "price": record.get("price"), "symbol": symbol}
+
+    def get_history(self, symbol, period="3mo", start=None):
+        if self.latency:
+            time.sleep(self.latency)
+        history = self.data.get(symbol.upper(), {}).get("history", [])
+        if not history:
+            return []
+        # Recordings are replayed relative to their last bar, not to today's date
+        start = start or period_start(period, datetime.date.fromisoformat(history[-1]["date"])).isoformat()
+        return [bar for bar in history if bar["date"] >= start]
+
+
+PROVIDERS = {
+    "yahoo": YahooProvider,
+    "synthetic": SyntheticProvider,
+    "replay": ReplayProvider,
+}
+
+
+@lru_cache(maxsize=None)
+def get_provider(name=QUOTE_PROVIDER):
+    """Return the shared quote provider instance selected by configuration."""
+    try:
+        return PROVIDERS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown quote provider: {name}")
@@ -0,0 +1,184 @@
+import os
+import threading
+import time
+import uuid
+from database import DATABASE, connect
+from helpers import QUOTE_BATCH_SIZE, demand, price_cache, quote_cache
+from providers import get_provider
+
+# Refresh intervals in seconds for hot (recently requested or widely held) and cold symbols
+PRICE_REFRESH_HOT = float(os.environ.get("PRICE_REFRESH_HOT", 5))
+PRICE_REFRESH_COLD = float(os.environ.get("PRICE_REFRESH_COLD", 60))
+# Symbols requested by a user within this many seconds count as hot
+PRICE_HOT_WINDOW = float(os.environ.get("PRICE_HOT_WINDOW", 300))
+# Symbols held or proposed by at least this many users count as hot
+PRICE_HOT_HOLDERS = int(os.environ.get("PRICE_HOT_HOLDERS", 5))
+# How often the set of tracked symbols is reloaded from the database
+PRICE_UNIVERSE_INTERVAL = float(os.environ.get("PRICE_UNIVERSE_INTERVAL", 30))
+# Seconds the process refreshing prices holds on to that role without renewing it, before another one takes over
+PRICE_REFRESHER_LEASE = float(os.environ.get("PRICE_REFRESHER_LEASE", 15))
+
+# Name of the lease deciding which process refreshes prices
+LEASE_NAME = "price-refresher"
+
+
+class PriceRefresher(threading.Thread):
+    """
+    Background worker keeping the prices table fresh for every ticker that is owned
+    or traded on the P2P market, so page requests don't wait on the quote provider.
+    Every process serving requests runs one to store the symbols its users requested in the price_demand table,
+    but only the one holding the lease in the leases table refreshes prices, so several server workers (or a
+    worker replacing one that died) never fetch the same prices twice.
+    """
+
+    def __init__(self, database=DATABASE, tick=1.0):
+        super().__init__(name="price-refresher", daemon=True)
+        self.database = database
+        self.tick = tick
+        self.stopped = threading.Event()
+        self.owner = uuid.uuid4().hex  # identifies this refresher in the leases table
+        self.holders = {}  # ticker -> number of users holding or proposing it
+        self.requested = {}  # ticker -> last time (epoch seconds) any process's user requested it
+        self.refreshed = {}  # ticker -> monotonic time of last refresh
+        self.universe_loaded = 0
+
+    def run(self):
+        conn = connect(self.database)
+        try:
+            while not self.stopped.is_set():
+                try:
+                    self.refresh_once(conn)
+                except Exception as e:
+                    print(f"Price refresher error: {e}")
+                self.stopped.wait(self.tick)
+        finally:
+            conn.close()
+
+    def stop(self):
+        self.stopped.set()
+
+    def refresh_once(self, conn):
+        """Store requested symbols, then refresh every symbol whose hot or cold interval has elapsed if this process holds the lease."""
+        self.store_demand(conn)
+        if not self.hold_lease(conn):
+            # Another process refreshes prices, start over if this one takes over later
+            self.refreshed = {}
+            self.universe_loaded = 0
+            return
+
+        now = time.monotonic()
+        if now - self.universe_loaded >= PRICE_UNIVERSE_INTERVAL:
+            self.holders = self.load_universe(conn)
+            self.universe_loaded = now
+            # Forget symbols nobody requested within the hot window
+            with conn:
+                conn.execute("DELETE FROM price_demand WHERE requested_at < ?", (time.time() - PRICE_HOT_WINDOW,))
+        self.requested = self.load_demand(conn)
+
+        tracked = set(self.holders) | set(self.requested)
+        self.refreshed = {ticker: refreshed for ticker, refreshed in self.refreshed.items() if ticker in tracked}
+
+        due = [ticker for ticker in tracked if now - self.refreshed.get(ticker, float("-inf")) >= self.interval(ticker)]
+        for i in range(0, len(due), QUOTE_BATCH_SIZE):
+            self.refresh(conn, due[i:i + QUOTE_BATCH_SIZE])
+
+    def load_universe(self, conn):
+        """Return ticker -> holder count for all owned and proposed stocks."""
+        rows = conn.execute("""
+            SELECT stock_ticker, COUNT(DISTINCT user_id) FROM (
+                SELECT stock_ticker, user_id FROM stock_ownership
+                UNION ALL
+                SELECT stock_ticker, user_id FROM p2p_market
+            )
+            GROUP BY stock_ticker
+        """).fetchall()
+        return dict(rows)
+
+    def store_demand(self, conn):
+        """Move symbols requested in this process since the last tick into the price_demand table."""
+        requested = {}
+        while demand:
+            try:
+                ticker, requested_at = demand.popitem()
+            except KeyError:
+                break
+            requested[ticker] = max(requested_at, requested.get(ticker, 0))
+        if not requested:
+            return
+
+        with conn:
+            conn.executemany(
+                """INSERT INTO price_demand (ticker, requested_at) VALUES (?, ?)
+                ON CONFLICT(ticker) DO UPDATE SET requested_at = MAX(requested_at, excluded.requested_at)""",
+                list(requested.items())
+            )
+
+    def hold_lease(self, conn):
+        """Take or renew the lease on refreshing prices if it is free, expired or already ours. Returns whether we hold it."""
+        now = time.time()
+        row = conn.execute("SELECT owner, expires_at FROM leases WHERE name = ?", (LEASE_NAME,)).fetchone()
+        if row and row[0] != self.owner and row[1] > now:
+            return False
+        # Renew halfway through the lease rather than writing on every tick
+        if row and row[0] == self.owner and row[1] - now > PRICE_REFRESHER_LEASE / 2:
+            return True
+
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO leases (name, owner, expires_at) VALUES (?, ?, 0)", (LEASE_NAME, self.owner))
+            return conn.execute(
+                "UPDATE leases SET owner = ?, expires_at = ? WHERE name = ? AND (owner = ? OR expires_at <= ?)",
+                (self.owner, now + PRICE_REFRESHER_LEASE, LEASE_NAME, self.owner, now)
+            ).rowcount == 1
+
+    def load_demand(self, conn):
+        """Return ticker -> last request time for symbols requested within the hot window."""
+        return dict(conn.execute("SELECT ticker, requested_at FROM price_demand WHERE requested_at >= ?", (time.time() - PRICE_HOT_WINDOW,)).fetchall())
+
+    def interval(self, ticker):
+        if ticker in self.requested or self.holders.get(ticker, 0) >= PRICE_HOT_HOLDERS:
+            return PRICE_REFRESH_HOT
+        return PRICE_REFRESH_COLD
+
+    def refresh(self, conn, tickers):
+        """Fetch prices for a batch of tickers and store them locally."""
+        provider = get_provider()
+        prices = provider.get_prices(tickers)
+        now = time.monotonic()
+
+        # Company names rarely change, so full quotes are only fetched for tickers we haven't named yet
+        named = {row[0] for row in conn.execute(
+            f"SELECT ticker FROM prices WHERE name IS NOT NULL AND ticker IN ({','.join('?' * len(tickers))})", tickers
+        )}
+        names = {}
+        for ticker in tickers:
+            if ticker not in named:
+                quote = provider.get_quote(ticker)
+                if quote and quote["name"] != "Unknown":
+                    names[ticker] = quote["name"]
+                    if ticker not in prices and quote["price"] is not None:
+                        prices[ticker] = quote["price"]
+
+        with conn:
+            conn.executemany(
+                """INSERT INTO prices (ticker, name, price, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(ticker) DO UPDATE SET
+                    name = COALESCE(excluded.name, prices.name),
+                    price = excluded.price,
+                    updated_at = excluded.updated_at""",
+                [(ticker, names.get(ticker), price, time.time()) for ticker, price in prices.items()]
+            )
+
+        for ticker in tickers:
+            self.refreshed[ticker] = now
+        for ticker, price in prices.items():
+            price_cache.set(ticker, price)
+            quote = quote_cache.last_known(ticker)
+            if quote:
+                quote_cache.set(ticker, {**quote, "price": price})
+
+
+def start_price_refresher():
+    """Start the background price refresher thread of this process and return it."""
+    refresher = PriceRefresher()
+    refresher.start()
+    return refresher
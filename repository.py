@@ -0,0 +1,441 @@
+import datetime
+from dataclasses import dataclass
+from database import execute_query
+
+# Data access layer: named read queries returning compact row objects, and named write
+# statements returned as (query, params[, error_message]) tuples for execute_transaction.
+
+
+@dataclass(slots=True)
+class User:
+    id: int
+    username: str
+    hash: str
+    cash: float
+    frozen_cash: float
+
+
+@dataclass(slots=True)
+class Portfolio:
+    cash: float
+    frozen_cash: float
+    cost_basis: float
+    shares: float
+    last_valuation: float
+    valued_at: datetime.datetime
+
+
+@dataclass(slots=True)
+class Holding:
+    stock_ticker: str
+    amount: float
+    frozen_amount: float
+    avg_price: float
+
+
+@dataclass(slots=True)
+class Proposal:
+    p2p_id: int
+    time_posted: datetime.datetime
+    stock_ticker: str
+    amount: float
+    price: float
+    type: str
+    comment: str
+    user_id: int
+    username: str = None
+
+
+@dataclass(slots=True)
+class Transaction:
+    time: datetime.datetime
+    ticker: str
+    price: float
+    amount: float
+    type: str
+    transaction_source: str
+    transaction_id: int
+    kind: int
+
+    @property
+    def cursor(self):
+        """Keyset position of this transaction, see list_transactions."""
+        return (self.time.isoformat(" "), self.transaction_id, self.kind)
+
+
+def _proposal(row):
+    return Proposal(row[0], datetime.datetime.fromisoformat(row[1]), *row[2:])
+
+
+# Users
+
+def get_user(user_id):
+    return _user(execute_query("SELECT id, username, hash, cash, frozen_cash FROM users WHERE id = ?", (user_id,), fetchone=True))
+
+
+def get_user_by_username(username):
+    return _user(execute_query("SELECT id, username, hash, cash, frozen_cash FROM users WHERE username = ?", (username,), fetchone=True))
+
+
+def _user(row):
+    return User(*row) if row else None
+
+
+def insert_user(username, passhash):
+    return ("INSERT INTO users (username, hash) VALUES (?, ?)", (username, passhash))
+
+
+def update_username(user_id, username):
+    return ("UPDATE users SET username = ? WHERE id = ?", (username, user_id))
+
+
+def update_password_hash(user_id, passhash):
+    return ("UPDATE users SET hash = ? WHERE id = ?", (passhash, user_id))
+
+
+def debit_cash(user_id, amount, error_message):
+    """Take cash from user, only if user has at least amount available."""
+    return ("UPDATE users SET cash = cash - ? WHERE id = ? AND cash >= ?", (amount, user_id, amount), error_message)
+
+
+def credit_cash(user_id, amount):
+    return ("UPDATE users SET cash = cash + ? WHERE id = ?", (amount, user_id))
+
+
+def freeze_cash(user_id, amount, error_message):
+    """Move cash into frozen cash, only if user has at least amount available."""
+    return (
+        "UPDATE users SET frozen_cash = frozen_cash + ?, cash = cash - ? WHERE id = ? AND cash >= ?",
+        (amount, amount, user_id, amount), error_message
+    )
+
+
+def unfreeze_cash(user_id, amount):
+    """Move frozen cash back into available cash."""
+    return ("UPDATE users SET frozen_cash = frozen_cash - ?, cash = cash + ? WHERE id = ?", (amount, amount, user_id))
+
+
+def release_frozen_cash(user_id, amount):
+    """Remove frozen cash that was spent on a P2P trade."""
+    return ("UPDATE users SET frozen_cash = frozen_cash - ? WHERE id = ?", (amount, user_id))
+
+
+def refreeze_cash(user_id, old_amount, new_amount, error_message):
+    """Replace old_amount of frozen cash with new_amount, only if user can cover the difference."""
+    return (
+        "UPDATE users SET frozen_cash = frozen_cash - ? + ?, cash = cash + ? - ? WHERE id = ? AND cash + ? >= ?",
+        (old_amount, new_amount, old_amount, new_amount, user_id, old_amount, new_amount), error_message
+    )
+
+
+# Portfolio summary
+
+def get_portfolio(user_id):
+    """User's cash together with the materialized summary of their holdings."""
+    row = execute_query(
+        """SELECT users.cash, users.frozen_cash, COALESCE(portfolio_summary.cost_basis, 0), COALESCE(portfolio_summary.shares, 0),
+            portfolio_summary.last_valuation, portfolio_summary.valued_at
+        FROM users LEFT JOIN portfolio_summary ON portfolio_summary.user_id = users.id
+        WHERE users.id = ?""",
+        (user_id,), fetchone=True
+    )
+    if not row:
+        return None
+    return Portfolio(*row[:5], datetime.datetime.fromisoformat(row[5]) if row[5] else None)
+
+
+def refresh_portfolio_summary(user_id):
+    """Recompute user's cost basis and share count from their holdings, run inside every trade."""
+    return (
+        """INSERT INTO portfolio_summary (user_id, cost_basis, shares)
+        SELECT ?, COALESCE(SUM(avg_price * (amount + frozen_amount)), 0), COALESCE(SUM(amount + frozen_amount), 0)
+        FROM stock_ownership WHERE user_id = ?
+        ON CONFLICT(user_id) DO UPDATE SET cost_basis = excluded.cost_basis, shares = excluded.shares""",
+        (user_id, user_id)
+    )
+
+
+def record_valuation(user_id, value):
+    return (
+        """INSERT INTO portfolio_summary (user_id, last_valuation, valued_at) VALUES (?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET last_valuation = excluded.last_valuation, valued_at = excluded.valued_at""",
+        (user_id, value, datetime.datetime.now().isoformat(" ", "seconds"))
+    )
+
+
+# Stock ownership
+
+def list_holdings(user_id, include_frozen=False):
+    """Stocks user has available (not frozen) shares of, or any shares at all if include_frozen is set."""
+    condition = "amount + frozen_amount > 0" if include_frozen else "amount > 0"
+    return [Holding(*row) for row in execute_query(
+        f"SELECT stock_ticker, amount, frozen_amount, avg_price FROM stock_ownership WHERE user_id = ? AND {condition}",
+        (user_id,)
+    )]
+
+
+def add_shares(user_id, ticker, shares, price):
+    """Add shares bought at price to user's portfolio, updating the average purchase price."""
+    return (
+        """INSERT INTO stock_ownership (stock_ticker, amount, avg_price, user_id)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id, stock_ticker)
+        DO UPDATE SET
+            amount = stock_ownership.amount + ?,
+            avg_price = ((stock_ownership.avg_price * stock_ownership.amount) + (? * ?)) / (stock_ownership.amount + ?)""",
+        (ticker, shares, price, user_id, shares, price, shares, shares)
+    )
+
+
+def remove_shares(user_id, ticker, shares, error_message):
+    """Take shares from user's portfolio, only if user owns at least that many."""
+    return (
+        "UPDATE stock_ownership SET amount = amount - ? WHERE user_id = ? AND stock_ticker = ? AND amount >= ?",
+        (shares, user_id, ticker, shares), error_message
+    )
+
+
+def delete_empty_holding(user_id, ticker):
+    """Remove stock entry if amount becomes zero and none of it is frozen in a proposal."""
+    return ("DELETE FROM stock_ownership WHERE user_id = ? AND stock_ticker = ? AND amount = 0 AND frozen_amount = 0", (user_id, ticker))
+
+
+def freeze_shares(user_id, ticker, shares, error_message):
+    """Move shares into frozen shares, only if user owns at least that many."""
+    return (
+        "UPDATE stock_ownership SET frozen_amount = frozen_amount + ?, amount = amount - ? WHERE user_id = ? AND stock_ticker = ? AND amount >= ?",
+        (shares, shares, user_id, ticker, shares), error_message
+    )
+
+
+def unfreeze_shares(user_id, ticker, shares):
+    """Move frozen shares back into available shares."""
+    return (
+        "UPDATE stock_ownership SET frozen_amount = frozen_amount - ?, amount = amount + ? WHERE user_id = ? AND stock_ticker = ?",
+        (shares, shares, user_id, ticker)
+    )
+
+
+def release_frozen_shares(user_id, ticker, shares):
+    """Remove frozen shares that were sold in a P2P trade."""
+    return ("UPDATE stock_ownership SET frozen_amount = frozen_amount - ? WHERE user_id = ? AND stock_ticker = ?", (shares, user_id, ticker))
+
+
+def refreeze_shares(user_id, ticker, old_shares, new_shares, error_message):
+    """Replace old_shares of frozen shares with new_shares, only if user can cover the difference."""
+    return (
+        """UPDATE stock_ownership SET frozen_amount = frozen_amount - ? + ?, amount = amount + ? - ?
+        WHERE user_id = ? AND stock_ticker = ? AND amount + ? >= ?""",
+        (old_shares, new_shares, old_shares, new_shares, user_id, ticker, old_shares, new_shares), error_message
+    )
+
+
+# Transactions
+
+def insert_market_transaction(user_id, ticker, shares, price, type):
+    return (
+        "INSERT INTO market_transactions (time_transacted, stock_ticker, price_per_share, shares, type, user_id) VALUES (?, ?, ?, ?, ?, ?)",
+        (datetime.datetime.now(), ticker, price, shares, type, user_id)
+    )
+
+
+def insert_p2p_transaction(buyer_id, seller_id, ticker, shares, price):
+    return (
+        "INSERT INTO p2p_transactions (time_transacted, stock_ticker, price_per_share, shares, buyer_id, seller_id) VALUES (?, ?, ?, ?, ?, ?)",
+        (datetime.datetime.now(), ticker, price, shares, buyer_id, seller_id)
+    )
+
+
+_TRANSACTION_BRANCHES = (
+    # (table, user column, type, source, kind) where kind breaks ties between rows from different tables
+    ("market_transactions", "user_id", "type", "MARKET", 0),
+    ("p2p_transactions", "buyer_id", "'BUY'", "P2P", 1),
+    ("p2p_transactions", "seller_id", "'SELL'", "P2P", 2),
+)
+
+
+def list_transactions(user_id, limit, before=None):
+    """
+    Combined market and P2P transactions of user, newest first.
+    Pages are keyset paginated on (time, transaction_id, kind): before is the cursor of the last row
+    already shown, so every page is an index range scan no matter how long the history is.
+    """
+    branches = []
+    params = []
+    for table, column, type_, source, kind in _TRANSACTION_BRANCHES:
+        keyset = ""
+        params.append(user_id)
+        if before:
+            keyset = " AND time_transacted <= ? AND (time_transacted, transaction_id, ?) < (?, ?, ?)"
+            params += [before[0], kind, *before]
+        branches.append(f"""SELECT * FROM (
+            SELECT time_transacted AS time, stock_ticker AS ticker, price_per_share AS price,
+                shares AS amount, {type_} AS type, '{source}' AS transaction_source, transaction_id, {kind} AS kind
+            FROM {table}
+            WHERE {column} = ?{keyset}
+            ORDER BY time_transacted DESC, transaction_id DESC
+            LIMIT ?
+        )""")
+        params.append(limit)
+
+    rows = execute_query(
+        " UNION ALL ".join(branches) + " ORDER BY time DESC, transaction_id DESC, kind DESC LIMIT ?",
+        (*params, limit)
+    )
+    return [Transaction(datetime.datetime.fromisoformat(row[0]), *row[1:]) for row in rows]
+
+
+def iter_transactions(user_id, chunk=500):
+    """Yield all transactions of user, newest first, fetching them one page at a time."""
+    before = None
+    while True:
+        transactions = list_transactions(user_id, chunk, before)
+        yield from transactions
+        if len(transactions) < chunk:
+            return
+        before = transactions[-1].cursor
+
+
+# P2P market
+
+_PROPOSAL_COLUMNS = "p2p_market.p2p_id, p2p_market.time_posted, p2p_market.stock_ticker, p2p_market.amount, p2p_market.price, p2p_market.type, p2p_market.comment, p2p_market.user_id"
+
+
+# Board sort orders: sort -> (column, direction)
+PROPOSAL_SORTS = {
+    "time": ("p2p_market.time_posted", "DESC"),
+    "price_asc": ("p2p_market.price", "ASC"),
+    "price_desc": ("p2p_market.price", "DESC"),
+}
+
+
+def list_proposals(limit, ticker=None, side=None, sort="time", after=None):
+    """
+    Open P2P proposals with the username of whoever posted them, optionally filtered by ticker and side (BUYING or SELLING).
+    Pages are keyset paginated: after is the proposal_cursor of the last proposal already shown.
+    """
+    column, direction = PROPOSAL_SORTS[sort]
+    conditions = []
+    params = []
+    if ticker:
+        conditions.append("p2p_market.stock_ticker = ?")
+        params.append(ticker)
+    if side:
+        conditions.append("p2p_market.type = ?")
+        params.append(side)
+    if after:
+        conditions.append(f"({column}, p2p_market.p2p_id) {'<' if direction == 'DESC' else '>'} (?, ?)")
+        params += after
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    return [_proposal(row) for row in execute_query(
+        f"""SELECT {_PROPOSAL_COLUMNS}, users.username FROM p2p_market JOIN users ON p2p_market.user_id = users.id
+        {where}
+        ORDER BY {column} {direction}, p2p_market.p2p_id {direction}
+        LIMIT ?""",
+        (*params, limit)
+    )]
+
+
+def proposal_cursor(proposal, sort):
+    """Keyset position of proposal in the board sorted by sort, see list_proposals."""
+    if sort == "time":
+        return (proposal.time_posted.isoformat(" "), proposal.p2p_id)
+    return (proposal.price, proposal.p2p_id)
+
+
+def list_user_proposals(user_id):
+    return [_proposal(row) for row in execute_query(
+        f"SELECT {_PROPOSAL_COLUMNS} FROM p2p_market WHERE user_id = ?", (user_id,)
+    )]
+
+
+def get_proposal(p2p_id):
+    row = execute_query(f"SELECT {_PROPOSAL_COLUMNS} FROM p2p_market WHERE p2p_id = ?", (p2p_id,), fetchone=True)
+    return _proposal(row) if row else None
+
+
+def list_ticker_proposals(ticker, after_id=0):
+    """Open proposals for ticker posted after p2p_id after_id, oldest first."""
+    return [_proposal(row) for row in execute_query(
+        f"SELECT {_PROPOSAL_COLUMNS} FROM p2p_market WHERE stock_ticker = ? AND p2p_id > ? ORDER BY p2p_id", (ticker, after_id)
+    )]
+
+
+def insert_proposal(user_id, ticker, shares, price, type, comment):
+    return (
+        "INSERT INTO p2p_market (time_posted, stock_ticker, price, amount, type, comment, user_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (datetime.datetime.now(), ticker, price, shares, type, comment, user_id)
+    )
+
+
+def update_proposal(proposal, shares, price, comment, error_message):
+    """Change proposal, only if it hasn't been accepted or changed since it was read."""
+    return (
+        "UPDATE p2p_market SET price = ?, amount = ?, comment = ? WHERE p2p_id = ? AND amount = ? AND price = ?",
+        (price, shares, comment, proposal.p2p_id, proposal.amount, proposal.price), error_message
+    )
+
+
+def claim_proposal(proposal, error_message):
+    """Remove proposal from the market, only if it hasn't been accepted or changed since it was read."""
+    return (
+        "DELETE FROM p2p_market WHERE p2p_id = ? AND amount = ? AND price = ?",
+        (proposal.p2p_id, proposal.amount, proposal.price), error_message
+    )
+
+
+def fill_proposal(proposal, shares, error_message):
+    """Take shares from proposal, only if it still has that many left at the same price."""
+    return (
+        "UPDATE p2p_market SET amount = amount - ? WHERE p2p_id = ? AND price = ? AND amount >= ?",
+        (shares, proposal.p2p_id, proposal.price, shares), error_message
+    )
+
+
+def delete_filled_proposal(p2p_id):
+    """Remove proposal from the market once nothing is left of it."""
+    return ("DELETE FROM p2p_market WHERE p2p_id = ? AND amount <= 0", (p2p_id,))
+
+
+# Local prices and price history
+
+def get_local_quote(ticker, since):
+    """Name and price of ticker from the prices table if it was updated after since (epoch seconds)."""
+    return execute_query(
+        "SELECT name, price FROM prices WHERE ticker = ? AND name IS NOT NULL AND updated_at >= ?",
+        (ticker, since), fetchone=True
+    )
+
+
+def get_local_prices(tickers, since):
+    """Dictionary of ticker -> price from the prices table for prices updated after since (epoch seconds)."""
+    return dict(execute_query(
+        f"SELECT ticker, price FROM prices WHERE ticker IN ({','.join('?' * len(tickers))}) AND updated_at >= ?",
+        (*tickers, since)
+    ))
+
+
+def get_history_range(ticker):
+    """First and last stored price history dates of ticker, (None, None) if nothing is stored."""
+    return execute_query("SELECT MIN(date), MAX(date) FROM price_history WHERE ticker = ?", (ticker,), fetchone=True)
+
+
+def list_price_history(ticker, start):
+    """Stored daily bars of ticker from start date onwards as dictionaries."""
+    return [
+        {"date": row[0], "open": row[1], "high": row[2], "low": row[3], "close": row[4], "volume": row[5]}
+        for row in execute_query(
+            "SELECT date, open, high, low, close, volume FROM price_history WHERE ticker = ? AND date >= ? ORDER BY date",
+            (ticker, start)
+        )
+    ]
+
+
+def upsert_price_bar(ticker, bar):
+    return (
+        """INSERT INTO price_history (ticker, date, open, high, low, close, volume) VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(ticker, date) DO UPDATE SET
+            open = excluded.open, high = excluded.high, low = excluded.low, close = excluded.close, volume = excluded.volume""",
+        (ticker, bar["date"], bar.get("open"), bar.get("high"), bar.get("low"), bar["close"], bar.get("volume"))
+    )
@@ -0,0 +1,104 @@
+import os
+import secrets
+import threading
+import time
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SessionInterface
+from database import DATABASE, TransactionError, connect, execute_query, execute_transaction
+
+# An unchanged session is only written back once its expiry has moved by this many seconds
+SESSION_WRITE_INTERVAL = float(os.environ.get("SESSION_WRITE_INTERVAL", 60))
+# Seconds between background purges of expired sessions
+SESSION_PURGE_INTERVAL = float(os.environ.get("SESSION_PURGE_INTERVAL", 300))
+
+
+class ServerSideSession(SecureCookieSession):
+    """Session data stored in the sessions table, identified by a random id kept in the cookie."""
+
+    def __init__(self, initial=None, sid=None, expires_at=0):
+        super().__init__(initial)
+        self.sid = sid or secrets.token_urlsafe(32)
+        self.new = sid is None
+        self.expires_at = expires_at  # expiry currently stored in database
+
+
+class SQLiteSessionInterface(SessionInterface):
+    """
+    Server-side sessions in the sessions table of the application database.
+    Keeping a session alive doesn't write on every request: an unchanged session is only stored again
+    when its expiry has moved by SESSION_WRITE_INTERVAL, so idle timeouts are accurate to that interval.
+    """
+
+    serializer = TaggedJSONSerializer()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            row = execute_query("SELECT data, expires_at FROM sessions WHERE sid = ? AND expires_at > ?", (sid, time.time()), fetchone=True)
+            if row:
+                try:
+                    return ServerSideSession(self.serializer.loads(row[0]), sid, row[1])
+                except ValueError as e:
+                    print(f"Session error: {e}")
+        return ServerSideSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        # Forget sessions that were cleared
+        if not session:
+            if session.modified and not session.new:
+                execute_transaction([("DELETE FROM sessions WHERE sid = ?", (session.sid,))])
+                response.delete_cookie(name, domain=domain, path=path, secure=self.get_cookie_secure(app),
+                                       samesite=self.get_cookie_samesite(app), httponly=self.get_cookie_httponly(app))
+            return
+
+        # Browser-session cookies still expire on the server after the configured lifetime
+        expires = self.get_expiration_time(app, session)
+        expires_at = time.time() + app.permanent_session_lifetime.total_seconds()
+        if not session.modified and expires_at - session.expires_at < SESSION_WRITE_INTERVAL:
+            return
+
+        try:
+            execute_transaction([(
+                """INSERT INTO sessions (sid, data, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(sid) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at""",
+                (session.sid, self.serializer.dumps(dict(session)), expires_at)
+            )])
+        except TransactionError as e:
+            print(f"Session error: {e}")
+            return
+        response.set_cookie(
+            name, session.sid, expires=expires, httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app)
+        )
+
+
+def purge_expired_sessions(database=DATABASE):
+    """Delete all expired sessions in one statement and return how many were removed."""
+    conn = connect(database)
+    try:
+        with conn:
+            return conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),)).rowcount
+    finally:
+        conn.close()
+
+
+def start_session_purger(interval=SESSION_PURGE_INTERVAL):
+    """Purge expired sessions every interval seconds in a background thread."""
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                purge_expired_sessions()
+            except Exception as e:
+                print(f"Session purge error: {e}")
+
+    thread = threading.Thread(target=run, name="session-purger", daemon=True)
+    thread.start()
+    return thread
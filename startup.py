@@ -0,0 +1,67 @@
+import builtins
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+# Set to 1 to print how long each import and initialization step takes while the app starts
+STARTUP_PROFILE = os.environ.get("STARTUP_PROFILE", "0") == "1"
+# Imports nested deeper than this are left out of the report, and so are steps faster than the minimum (milliseconds)
+STARTUP_PROFILE_DEPTH = int(os.environ.get("STARTUP_PROFILE_DEPTH", 1))
+STARTUP_PROFILE_MIN_MS = float(os.environ.get("STARTUP_PROFILE_MIN_MS", 1))
+
+started = time.perf_counter()
+timings = []  # (depth, name, seconds) in the order steps finished
+_depth = 0
+_import = builtins.__import__
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    """Time modules imported for the first time, including everything they import themselves."""
+    global _depth
+    if level or name in sys.modules:
+        return _import(name, globals, locals, fromlist, level)
+
+    _depth += 1
+    start = time.perf_counter()
+    try:
+        return _import(name, globals, locals, fromlist, level)
+    finally:
+        _depth -= 1
+        timings.append((_depth, f"import {name}", time.perf_counter() - start))
+
+
+@contextmanager
+def step(name):
+    """Time an initialization step."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.append((_depth, name, time.perf_counter() - start))
+
+
+def report():
+    """Print the startup profile and stop timing imports."""
+    if not STARTUP_PROFILE:
+        return
+    builtins.__import__ = _import
+
+    # Steps are recorded when they finish, so nested imports come before the one that pulled them in
+    pending = []
+    for depth, name, seconds in timings:
+        children = [row for row in pending if row[0] > depth]
+        pending = [row for row in pending if row[0] <= depth] + [(depth, name, seconds, children)]
+    print(f"Startup profile ({(time.perf_counter() - started) * 1000:.0f} ms total):", file=sys.stderr)
+
+    def show(rows):
+        for depth, name, seconds, children in rows:
+            if depth <= STARTUP_PROFILE_DEPTH and seconds * 1000 >= STARTUP_PROFILE_MIN_MS:
+                print(f"{seconds * 1000:9.1f} ms  {'  ' * depth}{name}", file=sys.stderr)
+                show(children)
+
+    show(pending)
+
+
+if STARTUP_PROFILE:
+    builtins.__import__ = _timed_import
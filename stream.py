@@ -0,0 +1,100 @@
+import json
+import os
+import threading
+import time
+from helpers import lookup_many
+
+# Set to 0 to have pages poll /quote_json instead of holding a Server-Sent Events connection open, e.g. with
+# gunicorn's threaded workers, where every open stream would take up a worker thread for as long as the page is open
+PRICE_STREAMING = os.environ.get("PRICE_STREAMING", "1") == "1"
+# Seconds between price updates pushed to streaming clients, or between polls when streaming is off
+STREAM_INTERVAL = float(os.environ.get("STREAM_INTERVAL", 5))
+# Seconds between keep-alive comments sent to idle streaming clients
+STREAM_HEARTBEAT = float(os.environ.get("STREAM_HEARTBEAT", 15))
+# Maximum number of symbols a single client can subscribe to
+STREAM_MAX_SYMBOLS = int(os.environ.get("STREAM_MAX_SYMBOLS", 50))
+
+
+class PriceFeed:
+    """
+    Shared upstream price feed for Server-Sent Events clients.
+    One background thread fetches prices for the union of all subscribed symbols every interval,
+    so any number of clients watching the same symbol cost a single fetch.
+    """
+
+    def __init__(self, app, interval=STREAM_INTERVAL):
+        self.app = app
+        self.interval = interval
+        self.subscriptions = {}  # symbol -> number of subscribed clients
+        self.prices = {}  # symbol -> latest price
+        self.version = 0
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def subscribe(self, symbols):
+        with self.condition:
+            for symbol in symbols:
+                self.subscriptions[symbol] = self.subscriptions.get(symbol, 0) + 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="price-feed", daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def unsubscribe(self, symbols):
+        with self.condition:
+            for symbol in symbols:
+                self.subscriptions[symbol] -= 1
+                if self.subscriptions[symbol] <= 0:
+                    del self.subscriptions[symbol]
+                    self.prices.pop(symbol, None)
+
+    def run(self):
+        while True:
+            with self.condition:
+                # Sleep until someone subscribes
+                while not self.subscriptions:
+                    self.condition.wait()
+                symbols = list(self.subscriptions)
+
+            try:
+                # lookup_many reads the local price table, which needs an app context
+                with self.app.app_context():
+                    prices, _ = lookup_many(symbols)
+            except Exception as e:
+                print(f"Price feed error: {e}")
+                prices = {}
+
+            with self.condition:
+                self.prices.update(prices)
+                self.version += 1
+                self.condition.notify_all()
+
+            time.sleep(self.interval)
+
+    def events(self, symbols):
+        """Yield Server-Sent Events with prices for symbols whenever the feed publishes new ones."""
+        self.subscribe(symbols)
+        try:
+            version = -1
+            sent = {}
+            while True:
+                with self.condition:
+                    if self.version == version:
+                        self.condition.wait(STREAM_HEARTBEAT)
+                    if self.version == version:
+                        prices = None
+                    else:
+                        version = self.version
+                        prices = {symbol: self.prices[symbol] for symbol in symbols if symbol in self.prices}
+
+                if prices is None:
+                    yield ": keep-alive\n\n"
+                    continue
+
+                # Only send prices that changed since this client's last event
+                changed = {symbol: price for symbol, price in prices.items() if sent.get(symbol) != price}
+                if changed:
+                    sent.update(changed)
+                    yield f"data: {json.dumps(changed)}\n\n"
+        finally:
+            self.unsubscribe(symbols)
@@ -0,0 +1,31 @@
+import itertools
+import os
+import sys
+import tempfile
+import pytest
+
+# Tests run against a throwaway database and offline quotes, configured before the app is imported
+os.environ["DATABASE"] = os.path.join(tempfile.mkdtemp(prefix="mockstocks-tests-"), "mockstocks.db")
+os.environ["QUOTE_PROVIDER"] = "synthetic"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as mockstocks
+
+# Unique usernames, the database is shared by all tests
+usernames = (f"user{i}" for i in itertools.count())
+
+
+@pytest.fixture
+def app():
+    mockstocks.app.config["TESTING"] = True
+    mockstocks.limiter.reset()
+    return mockstocks.app
+
+
+@pytest.fixture
+def user(client):
+    """Register a new user, logged in on client, and return its username."""
+    username = next(usernames)
+    response = client.post("/register", data={"username": username, "password": "secret1", "confirmation": "secret1"})
+    assert response.status_code == 302
+    return username
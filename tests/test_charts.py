@@ -0,0 +1,56 @@
+import datetime
+import json
+import pytest
+import helpers
+from providers import ReplayProvider, SyntheticProvider
+
+
+class FailingProvider(SyntheticProvider):
+    """Provider whose price history requests fail, like Yahoo Finance without a network."""
+
+    def get_history(self, symbol, period="3mo", start=None):
+        raise ConnectionError("network is unreachable")
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    helpers.history_sync.clear()
+    helpers.chart_cache.clear()
+
+
+def chart_dates(response):
+    return response.get_json()["data"][0]["x"]
+
+
+def test_chart_of_old_recording(app, client, user, tmp_path, monkeypatch):
+    # A weekday bar every day of a year long recording that ended a year and a half ago
+    end = datetime.date.today() - datetime.timedelta(days=550)
+    days = [end - datetime.timedelta(days=n) for n in range(365, -1, -1)]
+    history = [{"date": day.isoformat(), "open": 10, "high": 11, "low": 9, "close": 10, "volume": 100} for day in days if day.weekday() < 5]
+    recording = tmp_path / "quotes_replay.json"
+    recording.write_text(json.dumps({"OLDREC": {"name": "Old Recording Inc.", "price": 10, "history": history}}))
+    monkeypatch.setattr(helpers, "get_provider", lambda: ReplayProvider(str(recording)))
+
+    response = client.get("/chart_json", query_string={"symbol": "OLDREC", "period": "3mo"})
+    assert response.status_code == 200
+    dates = chart_dates(response)
+    assert dates[-1] == history[-1]["date"]
+    assert dates[0] >= (end - datetime.timedelta(days=93)).isoformat()
+
+
+def test_chart_from_stored_bars_when_provider_fails(app, client, user, monkeypatch):
+    response = client.get("/chart_json", query_string={"symbol": "STORED"})
+    assert response.status_code == 200
+    stored = chart_dates(response)
+
+    helpers.history_sync.clear()
+    helpers.chart_cache.clear()
+    monkeypatch.setattr(helpers, "get_provider", lambda: FailingProvider())
+    response = client.get("/chart_json", query_string={"symbol": "STORED"})
+    assert response.status_code == 200
+    assert chart_dates(response) == stored
+
+
+def test_chart_without_stored_bars_when_provider_fails(app, client, user, monkeypatch):
+    monkeypatch.setattr(helpers, "get_provider", lambda: FailingProvider())
+    assert client.get("/chart_json", query_string={"symbol": "NOTSTORED"}).status_code == 404
@@ -0,0 +1,48 @@
+import datetime
+from dataclasses import replace
+from matching import OrderBook
+from repository import Proposal
+
+POSTED = datetime.datetime(2025, 1, 2, 10, 0)
+
+
+def proposal(p2p_id, type, price, amount=1.0, user_id=1):
+    return Proposal(p2p_id, POSTED + datetime.timedelta(seconds=p2p_id), "AAPL", amount, price, type, "", user_id)
+
+
+def test_edits_keep_heaps_bounded():
+    book = OrderBook("AAPL")
+    bid = proposal(1, "BUYING", 100.0)
+    book.add(bid)
+    book.add(proposal(2, "BUYING", 90.0))
+
+    for edit in range(2000):
+        bid = replace(bid, price=100.0 + edit % 7, amount=1.0 + edit % 3)
+        book.add(bid)
+    assert len(book.bids) <= 3 * len(book.orders)
+
+    fills = book.match(proposal(3, "SELLING", 1.0, amount=bid.amount + 1, user_id=2))
+    assert [(resting.p2p_id, shares) for resting, shares in fills] == [(1, bid.amount), (2, 1.0)]
+    assert fills[0][0] == bid
+
+
+def test_edits_at_the_same_price_add_no_heap_entries():
+    book = OrderBook("AAPL")
+    ask = proposal(1, "SELLING", 100.0)
+    book.add(ask)
+    for amount in range(2, 100):
+        book.add(replace(ask, amount=float(amount)))
+    assert len(book.asks) == 1
+    assert book.orders[1].amount == 99.0
+
+
+def test_discarded_proposals_are_compacted():
+    book = OrderBook("AAPL")
+    for p2p_id in range(1, 101):
+        book.add(proposal(p2p_id, "SELLING", float(p2p_id)))
+    for p2p_id in range(1, 100):
+        book.discard(p2p_id)
+    assert len(book.asks) <= 3 * len(book.orders)
+
+    fills = book.match(proposal(101, "BUYING", 1000.0, user_id=2))
+    assert [(resting.p2p_id, shares) for resting, shares in fills] == [(100, 1.0)]
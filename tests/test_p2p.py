@@ -0,0 +1,48 @@
+import pytest
+from database import execute_query
+
+NOT_FINITE = ["nan", "NaN", "inf", "-inf", "Infinity"]
+
+
+def proposals(app, username):
+    """Return (amount, price) of username's open proposals."""
+    with app.app_context():
+        return execute_query(
+            "SELECT amount, price FROM p2p_market WHERE user_id = (SELECT id FROM users WHERE username = ?) ORDER BY p2p_id",
+            (username,)
+        )
+
+
+def propose(client, shares, price, type="BUYING"):
+    return client.post("/propose", data={"symbol": "AAPL", "shares": shares, "price": price, "type": type, "comment": ""})
+
+
+@pytest.mark.parametrize("value", NOT_FINITE)
+@pytest.mark.parametrize("field", ["shares", "price"])
+def test_propose_rejects_numbers_that_are_not_finite(app, client, user, field, value):
+    form = {"shares": "1", "price": "1"} | {field: value}
+    assert propose(client, **form).status_code == 400
+    assert proposals(app, user) == []
+
+
+@pytest.mark.parametrize("value", NOT_FINITE)
+@pytest.mark.parametrize("field", ["amount", "price"])
+def test_edit_rejects_numbers_that_are_not_finite(app, client, user, field, value):
+    assert propose(client, "1", "1").status_code == 302
+    with app.app_context():
+        trade_id = execute_query("SELECT MAX(p2p_id) FROM p2p_market", fetchone=True)[0]
+
+    form = {"trade_id": trade_id, "action": "edit", "amount": "2", "price": "2", "comment": ""} | {field: value}
+    assert client.post("/managep2p", data=form).status_code == 400
+    assert proposals(app, user) == [(1.0, 1.0)]
+
+
+def test_proposal_with_nan_price_does_not_match(app, client, user):
+    # A resting ask of another user that any bid would otherwise be compared against
+    seller = app.test_client()
+    seller.post("/register", data={"username": f"{user}-seller", "password": "secret1", "confirmation": "secret1"})
+    assert seller.post("/buy", data={"symbol": "AAPL", "shares": "1"}).status_code == 302
+    assert propose(seller, "1", "1900", "SELLING").status_code == 302
+
+    assert propose(client, "1", "nan").status_code == 400
+    assert proposals(app, f"{user}-seller") == [(1.0, 1900.0)]
@@ -0,0 +1,31 @@
+# Login attempts allowed per minute and client address
+LOGIN_LIMIT = 60
+
+
+def bad_login(client):
+    return client.post("/login", data={"username": "nobody", "password": "wrong"})
+
+
+def test_login_attempts_are_limited_with_cleared_cookies(app):
+    for attempt in range(LOGIN_LIMIT + 1):
+        # A new client each time starts with an empty cookie jar, and picks up a new session before logging in
+        client = app.test_client()
+        client.get("/static/styles.css")
+        assert bad_login(client).status_code == (429 if attempt == LOGIN_LIMIT else 400)
+
+
+def test_login_attempts_are_limited_with_cookies(client):
+    for _ in range(LOGIN_LIMIT):
+        client.get("/static/styles.css")
+        assert bad_login(client).status_code == 400
+
+    assert bad_login(client).status_code == 429
+
+
+def test_charts_are_not_limited_per_hour(client, user):
+    # The default limit is 100 requests per hour and route, charts are limited per minute instead
+    for _ in range(101):
+        assert client.get("/js/plotly-6.0.0.min.js").status_code == 200
+    for _ in range(60):
+        assert client.get("/chart_json", query_string={"symbol": "AAPL"}).status_code == 200
+    assert client.get("/chart_json", query_string={"symbol": "AAPL"}).status_code == 429